@@ -1,12 +1,19 @@
 import os
-import json
+import stat
 import asyncio
 import tempfile
 import shutil
 import time 
 import base64
+import hashlib
+import hmac
+from collections import ChainMap, OrderedDict
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import orjson
 from pathlib import Path
-from typing import List, Dict, Any, Optional 
+from typing import List, Dict, Any, Optional, Union
 from dotenv import load_dotenv
 
 from fastapi import (
@@ -14,36 +21,123 @@ from fastapi import (
     WebSocket, WebSocketDisconnect
 )
 from fastapi.security import APIKeyHeader
-from fastapi.responses import JSONResponse, FileResponse
-from fastapi.middleware.cors import CORSMiddleware  
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+from fastapi.middleware.cors import CORSMiddleware
+from starlette.websockets import WebSocketState  
 
 try:
-    from papelada.utils import load_json, save_json
-    from papelada.pipeline import load as load_pdfs
+    from papelada.utils import load_json, save_json, KeyedLock
+    from papelada.pipeline import load_items_async as load_pdfs_async, make_process_pool
     from papelada.orchestrator import run as run_orchestrator, load_memory
     from papelada.evaluation import evaluate_accuracy 
+    from papelada.cache import ResultCache, make_result_key, pdf_digest, config_fingerprint
+    from papelada.journal import MemoryJournal
+    from papelada.llm import make_http_client
 except ImportError:
     print("Erro: Não foi possível importar os módulos de 'papelada'...")
     exit(1)
 
 from openai import AsyncOpenAI
 
+try:
+    import pybase64 as b64codec # Descodificador Base64 SIMD (opcional)
+except ImportError:
+    b64codec = base64
+
 load_dotenv() 
 
+# --- Logging ---
+# Os handlers do logger só põem o registo numa fila; a escrita no stdout é feita
+# por uma thread (QueueListener), fora do event loop.
+logger = logging.getLogger("papelada")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+logger.addHandler(QueueHandler(_log_queue))
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(_log_queue, _log_stream_handler, respect_handler_level=True)
+
 app = FastAPI(
     title="Papelada API",
     description="API para extração de dados de PDFs usando uma arquitetura de aprendizagem híbrida.",
-    version="2.1.5 (Memory Fix)"
+    version="2.1.5 (Memory Fix)",
+    default_response_class=ORJSONResponse
 )
 
+# --- Limite do tamanho do corpo dos pedidos HTTP ---
+DEFAULT_MAX_BODY_BYTES = 100 * 1024 * 1024
+
+class _BodyTooLarge(HTTPException):
+    """
+    É uma HTTPException porque é lançada dentro do 'receive': o FastAPI converte
+    qualquer outra exceção do parsing do corpo (form/JSON) num 400 genérico, mas
+    deixa passar as HTTPException, que viram a resposta 413.
+    """
+    def __init__(self):
+        super().__init__(status_code=413, detail="Corpo do pedido demasiado grande.")
+
+class MaxBodySizeMiddleware:
+    """
+    Middleware ASGI que recusa (413) corpos HTTP acima de 'max_body_bytes' (config.json),
+    antes de o endpoint os ler para memória/disco. Verifica o Content-Length e, para
+    corpos 'chunked', conta os bytes à medida que chegam. (O WebSocket é limitado pelo
+    'ws_max_size' do Uvicorn.)
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        max_bytes = app_state.get("cfg", {}).get("max_body_bytes", DEFAULT_MAX_BODY_BYTES)
+        content_length = dict(scope.get("headers") or []).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+            return await self._reject(scope, receive, send)
+        
+        received = 0
+        response_started = False
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    raise _BodyTooLarge()
+            return message
+        
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            if not response_started:
+                await self._reject(scope, receive, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send):
+        await ORJSONResponse({"detail": "Corpo do pedido demasiado grande."}, status_code=413)(scope, receive, send)
+
+app.add_middleware(MaxBodySizeMiddleware)
+
 # --- Configuração de CORS ---
-origins = ["*"] 
+# A autenticação é feita pelo header X-API-Key (sem cookies), por isso não são
+# precisas credenciais CORS, e '*' com credenciais é proibido pela especificação.
+# Em produção, restrinja as origens com CORS_ORIGINS="https://a.com,https://b.com".
+origins = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()]
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*", "POST", "GET", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["*", "X-API-Key"],
+    allow_credentials=False,
+    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_headers=["X-API-Key", "Content-Type"],
+    max_age=86400, # O browser guarda o preflight por 24h
 )
 
 app_state: Dict[str, Any] = {
@@ -52,71 +146,363 @@ app_state: Dict[str, Any] = {
 }
 
 API_KEY = os.getenv("PAPELADA_API_KEY", "chave-secreta-de-teste") 
+_API_KEY_BYTES = API_KEY.encode("utf-8")
 api_key_header = APIKeyHeader(name="X-API-Key")
 
+def _is_valid_api_key(key: Optional[str]) -> bool:
+    """Compara a chave em tempo constante (sem canal lateral de tempo). Só aceita strings."""
+    return isinstance(key, str) and bool(key) and hmac.compare_digest(key.encode("utf-8"), _API_KEY_BYTES)
+
 async def get_api_key(key: str = Security(api_key_header)):
-    if key == API_KEY: return key
+    if _is_valid_api_key(key): return key
     else: raise HTTPException(status_code=403, detail="Chave de API inválida ou ausente")
 
-async def get_api_key_ws(key: str):
-    if key == API_KEY: return key
-    else: raise HTTPException(status_code=403, detail="Chave de API inválida ou ausente")
+def _write_file(path: Path, data: bytes):
+    """
+    Escreve um ficheiro em disco. Executado numa thread via asyncio.to_thread.
+    Usa os.open/os.write diretamente (sem a camada de buffer do open()), já que
+    o conteúdo inteiro está em memória.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+def _private_tmp_root(path_str: str) -> str:
+    """
+    Prepara a raiz dos uploads indicada em PAPELADA_TMP. Tem de ser um diretório
+    nosso e não um symlink: quem controlasse a raiz poderia trocar os diretórios
+    do pool por symlinks e desviar a escrita dos PDFs para outro lado.
+    """
+    Path(path_str).mkdir(mode=0o700, parents=True, exist_ok=True)
+    st = os.lstat(path_str)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError(f"{path_str} não é um diretório (ou é um symlink)")
+    if hasattr(os, "geteuid"):
+        if st.st_uid != os.geteuid():
+            raise OSError(f"{path_str} pertence a outro utilizador")
+        os.chmod(path_str, 0o700)
+    return path_str
+
+def _acquire_temp_dir() -> str:
+    """Tira um diretório temporário do pool (ou cria um novo, se o pool estiver vazio)."""
+    pool = app_state["tmp_dir_pool"]
+    return pool.pop() if pool else tempfile.mkdtemp(prefix="papelada_ws_", dir=app_state.get("tmp_root"))
+
+def _empty_dir(path: str):
+    """Apaga o conteúdo de um diretório, mantendo o próprio diretório."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+async def _release_temp_dir(path: str):
+    """Esvazia o diretório e devolve-o ao pool; se o pool estiver cheio, apaga-o."""
+    pool = app_state["tmp_dir_pool"]
+    if len(pool) < app_state["cfg"].get("temp_dir_pool_size", 4):
+        await asyncio.to_thread(_empty_dir, path)
+        pool.append(path)
+    else:
+        await asyncio.to_thread(shutil.rmtree, path)
+
+_background_io: set = set()
+
+def _spawn_background(coro):
+    """Lança uma tarefa de I/O 'fire-and-forget', mantendo uma referência até terminar."""
+    task = asyncio.create_task(coro)
+    _background_io.add(task)
+    task.add_done_callback(_on_background_done)
+    return task
+
+def _on_background_done(task: asyncio.Task):
+    _background_io.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Erro numa tarefa de I/O em background: %s", task.exception())
+
+MAX_CACHED_LLM_CLIENTS = 32
+
+def _get_llm_client(api_key: str) -> AsyncOpenAI:
+    """
+    Devolve o cliente OpenAI desta chave, reutilizando-o entre ligações (LRU,
+    indexado pelo SHA-256 da chave para não a guardar em claro como índice).
+    Todos partilham o mesmo httpx.AsyncClient, por isso um cliente despejado não
+    é fechado: basta deixá-lo ir (o pool de ligações continua vivo).
+    """
+    clients = app_state["llm_clients"]
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    client = clients.get(key_hash)
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=api_key, http_client=app_state["http_client"],
+            # O SDK repete os 429/5xx com backoff exponencial e respeita o Retry-After
+            max_retries=app_state["cfg"].get("llm_http", {}).get("max_retries", 4)
+        )
+        clients[key_hash] = client
+        while len(clients) > MAX_CACHED_LLM_CLIENTS:
+            clients.popitem(last=False)
+    else:
+        clients.move_to_end(key_hash)
+    return client
+
+async def _prewarm_llm_client(client: AsyncOpenAI):
+    """
+    Abre a ligação (TLS + HTTP/2) ao endpoint do LLM com um pedido barato, para
+    que a primeira extração não pague o handshake. Falhar aqui não é fatal.
+    """
+    try:
+        await client.models.list()
+        logger.info("Ligação ao LLM pré-aquecida.")
+    except Exception as e:
+        logger.warning("Não foi possível pré-aquecer a ligação ao LLM (%s).", e)
+
+def _strip_data_url(data_url: Union[str, bytes]) -> Union[str, bytes]:
+    """
+    Tira o prefixo 'data:...;base64,' (se existir). O rpartition procura a vírgula a
+    partir do fim e não cria a lista de fragmentos que o split(',') criaria.
+    """
+    separator = b"," if isinstance(data_url, (bytes, bytearray)) else ","
+    return data_url.rpartition(separator)[2]
+
+def _b64_decode(data_url: Union[str, bytes]) -> bytes:
+    """Descodifica o Base64 de um data-URL ('data:...;base64,XXXX') ou de Base64 simples."""
+    return b64codec.b64decode(_strip_data_url(data_url))
+
+async def _ws_send_json(websocket: WebSocket, data: Any):
+    """send_json com orjson. Envia um frame de texto (o frontend faz JSON.parse de strings)."""
+    await websocket.send_text(orjson.dumps(data).decode("utf-8"))
+
+async def _ws_receive_json(websocket: WebSocket) -> Any:
+    """receive_json com orjson."""
+    return orjson.loads(await websocket.receive_text())
+
+async def _send_progress_batches(websocket: WebSocket, queue: "asyncio.Queue", interval_s: float):
+    """
+    Envia os resultados de progresso em lotes ('progress_batch'): espera pelo primeiro,
+    junta o que chegar nos 'interval_s' seguintes e envia um único frame. Termina
+    (depois de enviar o que falta) ao receber None.
+    """
+    done = False
+    while not done:
+        batch = [await queue.get()]
+        await asyncio.sleep(interval_s)
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        if None in batch:
+            done = True
+            batch = [result for result in batch if result is not None]
+        if batch:
+            await _ws_send_json(websocket, {"type": "progress_batch", "results": batch})
+
+def _hydrate_schemas(extr_schema_list: list, pdf_path_map: Dict[str, str]) -> list:
+    """
+    Liga cada schema ao seu PDF numa única passagem: 'pdf_path' passa a ser o caminho
+    (ou chave 'mem://') do PDF recebido e o nome original fica em 'pdf_path_original'.
+    Schemas sem PDF correspondente no lote ficam de fora.
+    """
+    return [
+        {**schema_job, "pdf_path_original": schema_job["pdf_path"], "pdf_path": pdf_path_map[schema_job["pdf_path"]]}
+        for schema_job in extr_schema_list
+        if schema_job.get("pdf_path") in pdf_path_map
+    ]
+
+def _validate_schema_list(extr_schema_list: Any) -> Optional[str]:
+    """
+    Validação prévia (numa só passagem) do ficheiro de schema.
+    Devolve a mensagem de erro, ou None se o schema for válido.
+    """
+    if not isinstance(extr_schema_list, list):
+        return "O ficheiro de schema deve conter uma lista de trabalhos."
+    for i, schema_job in enumerate(extr_schema_list):
+        if not isinstance(schema_job, dict):
+            return f"Trabalho {i} do schema não é um objeto JSON."
+        if not isinstance(schema_job.get("pdf_path"), str):
+            return f"Trabalho {i} do schema: 'pdf_path' ausente ou inválido."
+        if not isinstance(schema_job.get("label"), str):
+            return f"Trabalho {i} do schema: 'label' ausente ou inválido."
+        if not isinstance(schema_job.get("extraction_schema"), dict):
+            return f"Trabalho {i} do schema: 'extraction_schema' ausente ou inválido."
+    return None
+
+def _validate_pdf_manifest(pdf_manifest: Any) -> Optional[str]:
+    """
+    Validação do manifesto [{name, size}] do protocolo binário, antes de ler os frames.
+    Os nomes viram nomes de ficheiro no diretório temporário: não podem conter caminhos.
+    Devolve a mensagem de erro, ou None se o manifesto for válido.
+    """
+    if not isinstance(pdf_manifest, list):
+        return "O manifesto de PDFs deve ser uma lista."
+    seen_names = set()
+    for i, entry in enumerate(pdf_manifest):
+        if not isinstance(entry, dict):
+            return f"Entrada {i} do manifesto não é um objeto JSON."
+        name = entry.get("name")
+        if not isinstance(name, str) or name in ("", ".", "..") or Path(name).name != name or "\\" in name:
+            return f"Entrada {i} do manifesto: 'name' ausente ou inválido."
+        if name in seen_names:
+            return f"Entrada {i} do manifesto: o PDF '{name}' aparece repetido."
+        seen_names.add(name)
+        size = entry.get("size")
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            return f"Entrada {i} do manifesto: 'size' ausente ou inválido."
+    return None
+
+def _is_cacheable(result: dict) -> bool:
+    """
+    Um resultado só vai para a cache se a extração correu bem: uma falha do LLM ou
+    um PDF ilegível deixam campos a 'null' que um novo envio pode vir a preencher.
+    """
+    if "error" in result or result.get("metrics", {}).get("llm_data_error"):
+        return False
+    return all(value is not None and value != 'null' for value in result.get("extracted_data", {}).values())
+
+async def _compact_memory():
+    """Incorpora o journal no memory.json. A cópia é tirada no loop; a escrita corre numa thread."""
+    journal = app_state["journal"]
+    # Com o memory_lock, um clear/upload não corre a meio e a cópia antiga não sobrescreve a nova
+    async with app_state["memory_lock"]:
+        snapshot = journal.rotate(app_state["memory"])
+        await asyncio.to_thread(journal.compact, snapshot, app_state["memory_path_str"])
+
+async def _compact_memory_periodically(interval_s: float):
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            await _compact_memory()
+            logger.info("Memória compactada (journal incorporado no memory.json).")
+        except Exception as e:
+            logger.error("Erro ao compactar a memória: %s", e)
 
 # --- Eventos de Startup e Shutdown ---
 @app.on_event("startup")
 async def startup_event():
-    print("--- A carregar recursos da API... ---")
+    log_listener.start()
+    logger.info("--- A carregar recursos da API... ---")
     try:
-        app_state["cfg"] = load_json(app_state["cfg_path"])
+        # Locks separados: a configuração e a memória não se bloqueiam mutuamente
+        # (criados primeiro: a compactação do arranque já usa o memory_lock)
+        app_state["cfg_lock"] = asyncio.Lock()
+        app_state["memory_lock"] = asyncio.Lock()
+        
+        app_state["cfg"] = await asyncio.to_thread(load_json, app_state["cfg_path"])
         app_state["memory_path_str"] = app_state["cfg"].get("memory_file", app_state["memory_path_str"])
         
         memory_path = Path(app_state["memory_path_str"])
-        app_state["memory"] = load_memory(memory_path)
+        app_state["memory"] = await asyncio.to_thread(load_memory, memory_path)
+        
+        # Regras aprendidas depois do último memory.json estão no journal (WAL)
+        journal_path = app_state["cfg"].get("memory_journal_file", str(memory_path.with_suffix(".wal.jsonl")))
+        app_state["journal"] = MemoryJournal(journal_path)
+        replayed = await asyncio.to_thread(app_state["journal"].replay, app_state["memory"])
+        app_state["journal"].bind(app_state["memory"])
+        if replayed:
+            logger.info("%s regra(s) recuperadas do journal %s.", replayed, journal_path)
+            await _compact_memory()
+        app_state["compaction_task"] = asyncio.create_task(
+            _compact_memory_periodically(app_state["cfg"].get("memory_compaction_interval_s", 3600))
+        )
+        
+        # Um único httpx.AsyncClient (HTTP/2, keep-alive) partilhado por todos os clientes
+        # OpenAI: as ligações TLS são reutilizadas entre pedidos e entre chaves.
+        app_state["http_client"] = make_http_client(app_state["cfg"].get("llm_http", {}))
+        # Limite global de chamadas LLM em simultâneo (evita rajadas de 429)
+        app_state["llm_sem"] = asyncio.Semaphore(app_state["cfg"].get("max_concurrent_llm", 32))
+        # Limite global de tarefas de aprendizado de regras (LLM + validação) em simultâneo
+        app_state["learning_sem"] = asyncio.Semaphore(app_state["cfg"].get("learning_concurrency", 8))
         
         # O cliente OpenAI será criado DENTRO do websocket_extract_live para usar a chave passada
         # Adiciona a fábrica de clientes ao estado
-        app_state["client_factory"] = lambda key: AsyncOpenAI(api_key=key)
+        app_state["llm_clients"] = OrderedDict()
+        app_state["client_factory"] = _get_llm_client
+        # Com uma chave no ambiente, o pool HTTP/2 partilhado já fica com a ligação aberta
+        if os.getenv("OPENAI_API_KEY"):
+            _spawn_background(_prewarm_llm_client(_get_llm_client(os.getenv("OPENAI_API_KEY"))))
+        
+        # Locks por label para as escritas de regras feitas pelo orquestrador
+        app_state["label_locks"] = KeyedLock()
+        
+        cache_cfg = app_state["cfg"].get("result_cache", {})
+        app_state["result_cache"] = ResultCache(
+            max_entries=cache_cfg.get("max_entries", 256),
+            ttl_s=cache_cfg.get("ttl_s", 86400)
+        )
+        
+        # Pool de processos para o parsing dos PDFs (CPU-bound), criado uma vez
+        app_state["pdf_pool"] = make_process_pool(os.cpu_count() or 1)
         
-        app_state["lock"] = asyncio.Lock()
+        # Uploads vão para tmpfs (RAM) quando existe; senão, para o temp do sistema
+        # Sem PAPELADA_TMP, cada arranque cria a sua própria pasta (0700) em /dev/shm, apagada no shutdown
+        app_state["tmp_root"] = None
+        app_state["tmp_root_owned"] = False
+        tmp_root_str = os.getenv("PAPELADA_TMP")
+        try:
+            if tmp_root_str:
+                app_state["tmp_root"] = _private_tmp_root(tmp_root_str)
+            elif Path("/dev/shm").is_dir():
+                tmp_root_str = "/dev/shm"
+                app_state["tmp_root"] = tempfile.mkdtemp(prefix="papelada_", dir=tmp_root_str)
+                app_state["tmp_root_owned"] = True
+        except OSError as e:
+            logger.warning("Não foi possível usar %s para ficheiros temporários (%s).", tmp_root_str, e)
+        
+        # Pool de diretórios temporários reutilizados entre ligações (sem mkdtemp/rmtree por pedido)
+        app_state["tmp_dir_pool"] = [
+            tempfile.mkdtemp(prefix="papelada_ws_", dir=app_state["tmp_root"])
+            for _ in range(app_state["cfg"].get("temp_dir_pool_size", 4))
+        ]
         
         Path("results").mkdir(exist_ok=True)
-        print("Recursos carregados com sucesso.")
-    except Exception as e:
-        print(f"ERRO FATAL ao iniciar a API: {e}")
+        logger.info("Recursos carregados com sucesso.")
+    except Exception:
+        logger.exception("ERRO FATAL ao iniciar a API")
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    print("--- A guardar a memória antes de desligar... ---")
-    if "memory" in app_state and "cfg" in app_state:
-        memory_file_path = app_state["cfg"].get("memory_file")
-        if memory_file_path:
-            try:
-                save_json(app_state["memory"], memory_file_path)
-                print("Memória guardada com sucesso.")
-            except Exception as e:
-                print(f"Erro ao guardar a memória: {e}")
+    # Cada regra nova já foi escrita no journal quando foi aprendida: não é
+    # preciso reescrever a memória inteira aqui. O próximo arranque incorpora-o.
+    logger.info("--- A desligar (a memória está persistida no journal)... ---")
+    compaction_task = app_state.get("compaction_task")
+    if compaction_task:
+        compaction_task.cancel()
+    pdf_pool = app_state.get("pdf_pool")
+    if pdf_pool:
+        pdf_pool.shutdown(wait=False, cancel_futures=True)
+    for pooled_dir in app_state.get("tmp_dir_pool", []):
+        shutil.rmtree(pooled_dir, ignore_errors=True)
+    if app_state.get("tmp_root_owned"):
+        shutil.rmtree(app_state["tmp_root"], ignore_errors=True)
+    http_client = app_state.get("http_client")
+    if http_client:
+        await http_client.aclose()
+    log_listener.stop() # Despeja os registos ainda na fila
 
 # --- NOVO ENDPOINT DE WEBSOCKET PARA EXTRAÇÃO AO VIVO ---
 
 @app.websocket("/ws/extract_live/")
 async def websocket_extract_live(websocket: WebSocket):
     await websocket.accept()
-    print("\nDEBUG: WebSocket Conectado. Aguardando mensagem de configuração...")
+    logger.debug("WebSocket Conectado. Aguardando mensagem de configuração...")
     
     config_data = None
     temp_dir = None
-    all_extraction_results = []
+    progress_sender = None
     
     try:
-        # 1. Esperar pela mensagem de configuração e ficheiros (Base64)
-        config_data = await websocket.receive_json()
-        print("DEBUG: Mensagem de configuração recebida.")
+        # 1. Esperar pela mensagem de configuração (schema, chaves e manifesto dos PDFs).
+        #    Os PDFs chegam depois, um frame binário por PDF (ver passo 3).
+        config_data = await _ws_receive_json(websocket)
+        logger.debug("Mensagem de configuração recebida.")
         
         # 2. Validar API Key
         papelada_api_key = config_data.get("papelada_api_key")
-        if not papelada_api_key or papelada_api_key != API_KEY:
-            print(f"DEBUG: Falha na autenticação da Papelada API Key. Chave recebida: {papelada_api_key}")
-            await websocket.send_json({"type": "error", "message": "Chave de API Papelada inválida ou ausente."})
+        if not _is_valid_api_key(papelada_api_key):
+            logger.warning("Falha na autenticação da Papelada API Key.")
+            await _ws_send_json(websocket, {"type": "error", "message": "Chave de API Papelada inválida ou ausente."})
             await websocket.close(code=1008)
             return
 
@@ -130,151 +516,267 @@ async def websocket_extract_live(websocket: WebSocket):
         current_mode = config_data.get("mode", "smart")
         llm_client = None
         
-        print(f"DEBUG: Chave Papelada OK. Chave OpenAI (após fallback): {'*' * len(openai_api_key) if openai_api_key else 'None'}. Modo: {current_mode}")
+        logger.debug("Chave Papelada OK. Chave OpenAI (após fallback): %s. Modo: %s", '*' * len(openai_api_key) if openai_api_key else 'None', current_mode)
 
         # 3. AGORA, verifica se (após todas as tentativas) a chave ainda está ausente
         if openai_api_key:
             # Se uma chave FOI encontrada (no app ou .env), tente usá-la.
             try:
                 llm_client = app_state["client_factory"](openai_api_key)
-                await websocket.send_json({"type": "status", "message": "Cliente LLM (OpenAI) inicializado com sucesso."})
-                print("DEBUG: Cliente LLM (OpenAI) inicializado com sucesso.")
+                await _ws_send_json(websocket, {"type": "status", "message": "Cliente LLM (OpenAI) inicializado com sucesso."})
+                logger.debug("Cliente LLM (OpenAI) inicializado com sucesso.")
             except Exception as e:
                 # Se a chave for inválida (ex: "sk-123"), isso é um erro fatal.
-                print(f"DEBUG: Falha ao inicializar cliente OpenAI. Chave inválida? Erro: {e}")
-                await websocket.send_json({"type": "error", "message": f"Falha ao inicializar cliente OpenAI (Chave inválida?): {e}"})
+                logger.warning("Falha ao inicializar cliente OpenAI. Chave inválida? Erro: %s", e)
+                await _ws_send_json(websocket, {"type": "error", "message": f"Falha ao inicializar cliente OpenAI (Chave inválida?): {e}"})
                 await websocket.close(code=1008)
                 return
         else:
             # Se NENHUMA chave foi encontrada
             if current_mode != "standard":
                 # Apenas envie um AVISO. O Orquestrador vai falhar se precisar do LLM.
-                print("DEBUG: Nenhuma chave OpenAI encontrada, mas o modo 'smart'/'pro' foi selecionado. Enviando aviso.")
-                await websocket.send_json({"type": "status", "message": "Aviso: Chave OpenAI não fornecida. A extração por LLM falhará. Apenas regras de memória funcionarão."})
+                logger.debug("Nenhuma chave OpenAI encontrada, mas o modo 'smart'/'pro' foi selecionado. Enviando aviso.")
+                await _ws_send_json(websocket, {"type": "status", "message": "Aviso: Chave OpenAI não fornecida. A extração por LLM falhará. Apenas regras de memória funcionarão."})
             else:
                 # Modo Standard, tudo bem.
-                print("DEBUG: Nenhuma chave OpenAI encontrada. Modo 'standard' selecionado. OK.")
-                await websocket.send_json({"type": "status", "message": "Chave OpenAI não fornecida. A executar em modo 'Standard' (apenas memória)."})
+                logger.debug("Nenhuma chave OpenAI encontrada. Modo 'standard' selecionado. OK.")
+                await _ws_send_json(websocket, {"type": "status", "message": "Chave OpenAI não fornecida. A executar em modo 'Standard' (apenas memória)."})
         
         # O código agora continua, mesmo que llm_client seja None.
         # --- FIM DA MUDANÇA ---
 
 
-        await websocket.send_json({"type": "status", "message": "Chaves válidas. A preparar ficheiros..."})
-        print("DEBUG: Lendo e decodificando arquivos...")
+        await _ws_send_json(websocket, {"type": "status", "message": "Chaves válidas. A preparar ficheiros..."})
+        logger.debug("Lendo e decodificando arquivos...")
 
-        # 3. Preparar ficheiros a partir de Base64
-        temp_dir = tempfile.mkdtemp(prefix="papelada_ws_")
-        temp_dir_path = Path(temp_dir)
+        # 3. Preparar ficheiros (schema/referência em Base64; PDFs em frames binários)
         pdf_path_map = {}
         
         # Ficheiro de Schema
         schema_file = config_data.get("schema_file", {})
-        schema_content_b64 = schema_file.get("content", "").split(',')[-1]
-        schema_content = base64.b64decode(schema_content_b64).decode('utf-8')
-        extr_schema_list = json.loads(schema_content)
+        extr_schema_list = orjson.loads(await asyncio.to_thread(_b64_decode, schema_file.get("content", "")))
+        
+        # Rejeita logo um schema malformado, antes de descodificar e gravar os PDFs
+        schema_error = _validate_schema_list(extr_schema_list)
+        if schema_error:
+            logger.warning("Schema inválido: %s", schema_error)
+            await _ws_send_json(websocket, {"type": "error", "message": f"Schema inválido: {schema_error}"})
+            await websocket.close(code=1008)
+            return
         
         # Ficheiros PDF
-        pdf_files = config_data.get("pdf_files", [])
-        for pdf in pdf_files:
-            file_name = pdf.get("name")
-            file_content_b64 = pdf.get("content", "").split(',')[-1]
-            file_bytes = base64.b64decode(file_content_b64)
-            file_path = temp_dir_path / file_name
-            with open(file_path, "wb") as f:
-                f.write(file_bytes)
-            pdf_path_map[file_name] = str(file_path)
+        # Lotes pequenos ficam em memória e são lidos direto dos bytes (sem ida e
+        # volta ao disco); acima do limite, os PDFs vão para o diretório temporário.
+        max_inmem_bytes = app_state["cfg"].get("max_inmem_bytes", 64 * 1024 * 1024)
+        pdf_bytes = {}
+        pending_digests = {}
+        pending_writes = []
+        
+        def stage_pdf(file_name: str, file_bytes: bytes):
+            """Regista um PDF e lança já (em threads) o hash e, se for o caso, a escrita em disco."""
+            pending_digests[file_name] = asyncio.ensure_future(asyncio.to_thread(pdf_digest, file_bytes))
+            if keep_in_memory:
+                pdf_bytes[file_name] = file_bytes
+                pdf_path_map[file_name] = f"mem://{file_name}" # Chave sintética, no lugar do caminho
+            else:
+                file_path = Path(temp_dir) / file_name
+                pending_writes.append(asyncio.ensure_future(asyncio.to_thread(_write_file, file_path, file_bytes)))
+                pdf_path_map[file_name] = str(file_path)
+        
+        pdf_manifest = config_data.get("pdf_manifest")
+        if pdf_manifest is not None:
+            # Protocolo binário: a seguir ao JSON, um frame binário por PDF, pela
+            # ordem do manifesto [{name, size}]. Sem Base64 (~33% menos bytes) e
+            # sem strings gigantes para descodificar no event loop.
+            # Os tamanhos declarados permitem decidir já entre memória e disco, e
+            # cada PDF começa a ser escrito enquanto o frame seguinte chega.
+            manifest_error = _validate_pdf_manifest(pdf_manifest)
+            if manifest_error:
+                logger.warning("Manifesto inválido: %s", manifest_error)
+                await _ws_send_json(websocket, {"type": "error", "message": f"Manifesto inválido: {manifest_error}"})
+                await websocket.close(code=1008)
+                return
+            keep_in_memory = sum(entry["size"] for entry in pdf_manifest) <= max_inmem_bytes
+            if not keep_in_memory:
+                temp_dir = _acquire_temp_dir()
+            for entry in pdf_manifest:
+                file_bytes = await websocket.receive_bytes()
+                if len(file_bytes) != entry["size"]:
+                    # O tamanho declarado decide memória vs. disco: não pode mentir
+                    message = f"O PDF '{entry['name']}' tem {len(file_bytes)} bytes, mas o manifesto declara {entry['size']}."
+                    logger.warning(message)
+                    await _ws_send_json(websocket, {"type": "error", "message": message})
+                    await websocket.close(code=1008)
+                    return
+                stage_pdf(entry["name"], file_bytes)
+        else:
+            # Protocolo antigo (compatibilidade): PDFs em Base64 dentro do JSON,
+            # descodificados em threads para não parar o event loop
+            legacy_pdfs = config_data.get("pdf_files", [])
+            # Os nomes têm as mesmas regras do manifesto (sem caminhos nem repetidos);
+            # o tamanho só se conhece depois de descodificar
+            legacy_error = _validate_pdf_manifest(
+                [{"name": pdf.get("name"), "size": 0} if isinstance(pdf, dict) else pdf for pdf in legacy_pdfs]
+                if isinstance(legacy_pdfs, list) else legacy_pdfs
+            )
+            if legacy_error:
+                logger.warning("Lista de PDFs inválida: %s", legacy_error)
+                await _ws_send_json(websocket, {"type": "error", "message": f"Lista de PDFs inválida: {legacy_error}"})
+                await websocket.close(code=1008)
+                return
+            decoded = await asyncio.gather(*(asyncio.to_thread(_b64_decode, pdf.get("content", "")) for pdf in legacy_pdfs))
+            keep_in_memory = sum(len(data) for data in decoded) <= max_inmem_bytes
+            if not keep_in_memory:
+                temp_dir = _acquire_temp_dir()
+            for pdf, file_bytes in zip(legacy_pdfs, decoded):
+                stage_pdf(pdf.get("name"), file_bytes)
+        
+        # As escritas em disco e os hashes (chave da cache) correm em paralelo (threads),
+        # sem bloquear o event loop
+        await asyncio.gather(*pending_writes)
+        pdf_digests = dict(zip(pending_digests, await asyncio.gather(*pending_digests.values())))
 
         # Ficheiro de Referência (Opcional)
         ref_json = None
-        ref_file = config_data.get("reference_file") # Pode ser None
-        if ref_file and ref_file.get("content"): # Verifica se ref_file não é None
-            ref_content_b64 = ref_file.get("content", "").split(',')[-1]
-            ref_content = base64.b64decode(ref_content_b64).decode('utf-8')
-            ref_json = json.loads(ref_content)
-            print("DEBUG: Arquivo de referência (teste) carregado.")
-        
-        await websocket.send_json({"type": "status", "message": f"{len(pdf_files)} PDFs prontos. A iniciar o orquestrador..."})
-        print("DEBUG: Arquivos prontos. Hidratando schemas...")
-
-        # 4. "Hidratar" Schemas (igual a antes)
-        valid_schemas_to_run = []
-        pdf_paths_to_load = []
-        for schema_job in extr_schema_list:
-            pdf_name = schema_job.get("pdf_path")
-            if pdf_name in pdf_path_map:
-                schema_job["pdf_path_original"] = pdf_name 
-                schema_job["pdf_path"] = pdf_path_map[pdf_name] 
-                valid_schemas_to_run.append(schema_job)
-                pdf_paths_to_load.append(pdf_path_map[pdf_name])
-            else:
-                print(f"Aviso: O schema para {pdf_name} foi ignorado (PDF não enviado no lote).")
+        ref_content_b64 = (config_data.get("reference_file") or {}).get("content") # 'reference_file' pode ser None
+        if ref_content_b64:
+            ref_json = orjson.loads(await asyncio.to_thread(_b64_decode, ref_content_b64))
+            logger.debug("Arquivo de referência (teste) carregado.")
+        
+        await _ws_send_json(websocket, {"type": "status", "message": f"{len(pdf_path_map)} PDFs prontos. A iniciar o orquestrador..."})
+        logger.debug("Arquivos prontos. Hidratando schemas...")
+
+        # 4. "Hidratar" Schemas
+        valid_schemas_to_run = _hydrate_schemas(extr_schema_list, pdf_path_map)
+        if len(valid_schemas_to_run) != len(extr_schema_list):
+            dropped = {schema_job.get("pdf_path") for schema_job in extr_schema_list} - pdf_path_map.keys()
+            logger.warning("Schemas ignorados (PDF não enviado no lote): %s", sorted(dropped))
         
         if not valid_schemas_to_run:
-            print("DEBUG: Erro - Nenhum PDF corresponde aos schemas.")
-            await websocket.send_json({"type": "error", "message": "Nenhum PDF enviado corresponde aos schemas."})
+            logger.warning("Nenhum PDF corresponde aos schemas.")
+            await _ws_send_json(websocket, {"type": "error", "message": "Nenhum PDF enviado corresponde aos schemas."})
             await websocket.close(code=1008)
             return
 
-        print("DEBUG: Schemas prontos. Carregando PDFs...")
+        # 4b. Cache de resultados: só os trabalhos sem 'hit' vão ao orquestrador (e ao LLM)
+        result_cache = app_state["result_cache"]
+        cache_keys = {}
+        cached_results = []
+        schemas_to_run = []
+        cfg_fingerprint = config_fingerprint(app_state["cfg"])
+        for schema_job in valid_schemas_to_run:
+            pdf_name = schema_job["pdf_path_original"]
+            cache_key = make_result_key(pdf_digests[pdf_name], schema_job, current_mode, cfg_fingerprint)
+            cached = result_cache.get(cache_key)
+            if cached is None:
+                cache_keys[pdf_name] = cache_key
+                schemas_to_run.append(schema_job)
+            else:
+                cached["pdf_path"] = pdf_name
+                cached_results.append(cached)
+        
+        if cached_results:
+            logger.debug("%s resultado(s) servidos pela cache.", len(cached_results))
+
+        logger.debug("Schemas prontos. Carregando PDFs...")
         # 5. Preparar para o Orquestrador
-        current_cfg = app_state["cfg"].copy()
-        current_cfg["mode"] = config_data.get("mode", "smart")
+        # Vista sobre a configuração partilhada com o modo deste pedido por cima (sem copiar).
+        # O /config/ substitui o dict inteiro (copy-on-write), por isso esta vista fica estável.
+        current_cfg = ChainMap({"mode": config_data.get("mode", "smart")}, app_state["cfg"])
         
-        raw_processed_pdfs = load_pdfs(pdf_paths_to_load, current_cfg)
-        processed_pdfs_for_orchestrator = {}
-        for filename_key, data in raw_processed_pdfs.items():
-            full_path_key = str(temp_dir_path / filename_key)
-            processed_pdfs_for_orchestrator[full_path_key] = data
+        # Não espera pelo parsing: cada PDF é um 'future' que o orquestrador aguarda
+        # só quando chega a sua vez, sobrepondo o parsing às chamadas ao LLM.
+        # As chaves já são os 'pdf_path' que o orquestrador procura (sem re-mapear).
+        processed_pdfs_for_orchestrator = load_pdfs_async(
+            {
+                schema_job["pdf_path"]: pdf_bytes[schema_job["pdf_path_original"]] if keep_in_memory else schema_job["pdf_path"]
+                for schema_job in schemas_to_run
+            },
+            current_cfg, executor=app_state["pdf_pool"]
+        )
 
-        print("DEBUG: PDFs carregados. Iniciando Orquestrador...")
+        logger.debug("Parsing dos PDFs agendado. Iniciando Orquestrador...")
         # 6. Definir o Callback de Progresso
         
+        # O progresso vai para uma fila; uma tarefa envia-o em lotes, para que o
+        # orquestrador não fique à espera de um frame por PDF.
+        progress_queue: asyncio.Queue = asyncio.Queue()
+        progress_sender = asyncio.create_task(_send_progress_batches(
+            websocket, progress_queue, app_state["cfg"].get("progress_batch_interval_s", 0.02)
+        ))
+        
         async def progress_callback(data: dict):
             """Função injetada no orquestrador para enviar atualizações."""
             if data["type"] == "progress":
-                print(f"DEBUG: Orquestrador enviou progresso para {data['result'].get('pdf_path_original')}")
-                # Adiciona o resultado à nossa lista
                 result = data["result"]
                 
-                # Limpa o resultado para envio (remove dados locais)
-                if "pdf_path_original" in result:
-                    # Usa o nome original do PDF para a UI
-                    result["pdf_path"] = result.pop("pdf_path_original") 
+                # Limpa o resultado para envio (remove dados locais): usa o nome
+                # original do PDF para a UI ('hits' da cache já o trazem em 'pdf_path')
+                result["pdf_path"] = result.pop("pdf_path_original", result["pdf_path"])
+                logger.debug("Orquestrador enviou progresso para %s", result['pdf_path'])
                 
-                all_extraction_results.append(result)
-                
-                # Envia a atualização de progresso para a UI (EXTRAÇÃO INDIVIDUAL)
-                await websocket.send_json({
-                    "type": "progress",
-                    "result": result
-                })
+                # Entra no próximo lote de progresso para a UI
+                progress_queue.put_nowait(result)
             elif data["type"] == "error":
-                print(f"DEBUG: Orquestrador enviou erro: {data['message']}")
-                await websocket.send_json(data)
+                logger.debug("Orquestrador enviou erro: %s", data['message'])
+                await _ws_send_json(websocket, data)
         
+        # Os 'hits' da cache são enviados de imediato, antes de qualquer chamada ao LLM
+        for cached in cached_results:
+            cached["cache_hit"] = True
+            cached["metrics"] = {}
+            cached["sync_data_time_s"] = 0.0
+            await progress_callback({"type": "progress", "result": cached})
+
         # 7. Executar o Orquestrador (Não espera pelas tarefas de aprendizado)
         # --- MUDANÇA CRÍTICA: Remover .copy() ---
         # Devemos passar a REFERÊNCIA para a memória, não uma cópia.
-        async with app_state["lock"]:
-            memory_to_use = app_state["memory"] # Passa a referência direta
-
-        initial_results, background_tasks = await run_orchestrator(
-            cfg=current_cfg,
-            extr_schema=valid_schemas_to_run,
-            processed_pdfs=processed_pdfs_for_orchestrator, 
-            memory=memory_to_use, # Passa a referência, não o snapshot
-            client=llm_client, # Pode ser None
-            memory_lock=app_state["lock"],
-            progress_callback=progress_callback
-        )
+        # (Ler a referência não precisa de lock; as escritas usam os locks por label.)
+        memory_to_use = app_state["memory"]
+
+        orchestrator_results, background_tasks = [], []
+        if schemas_to_run:
+            orchestrator_results, background_tasks = await run_orchestrator(
+                cfg=current_cfg,
+                extr_schema=schemas_to_run,
+                processed_pdfs=processed_pdfs_for_orchestrator, 
+                memory=memory_to_use, # Passa a referência, não o snapshot
+                client=llm_client, # Pode ser None
+                memory_lock=app_state["label_locks"],
+                progress_callback=progress_callback,
+                journal=app_state["journal"],
+                llm_semaphore=app_state["llm_sem"],
+                learning_semaphore=app_state["learning_sem"]
+            )
         # --- FIM DA MUDANÇA ---
         
-        print("DEBUG: Orquestrador CONCLUÍDO (Extração Síncrona). Enviando 'extraction_complete'...")
+        # Só guarda resultados completos: com o LLM disponível (sem cliente, o resultado
+        # depende apenas da memória e pode melhorar) e sem falhas nem campos por preencher.
+        if llm_client is not None:
+            for result in orchestrator_results:
+                cache_key = cache_keys.get(result["pdf_path"])
+                if cache_key and _is_cacheable(result):
+                    result_cache.put(cache_key, result)
+        
+        # Junta 'hits' e novos resultados, pela ordem original do schema
+        results_by_pdf = {result["pdf_path"]: result for result in cached_results + orchestrator_results}
+        initial_results = [
+            results_by_pdf[schema_job["pdf_path_original"]]
+            for schema_job in valid_schemas_to_run
+            if schema_job["pdf_path_original"] in results_by_pdf
+        ]
+        
+        # Esvazia a fila de progresso antes de mudar de tela na UI
+        progress_queue.put_nowait(None)
+        await progress_sender
+        
+        logger.debug("Orquestrador CONCLUÍDO (Extração Síncrona). Enviando 'extraction_complete'...")
         # 8. Enviar Mensagem de Extração COMPLETA (SINAL PARA MUDAR DE TELA)
-        await websocket.send_json({
+        # Os resultados já seguiram um a um nos lotes de progresso; aqui vai só a
+        # contagem (a lista completa fica no servidor, para a avaliação).
+        await _ws_send_json(websocket, {
             "type": "extraction_complete",
-            "results": initial_results,
+            "count": len(initial_results),
         })
         
         # --- PROCESSOS DE FUNDO INICIAM AQUI ---
@@ -284,14 +786,12 @@ async def websocket_extract_live(websocket: WebSocket):
         report_path_str = None
         
         if ref_json:
-            print("DEBUG: Processando avaliação (se houver)...")
-            await websocket.send_json({"type": "status", "message": "A gerar relatório de avaliação..."})
+            logger.debug("Processando avaliação (se houver)...")
+            await _ws_send_json(websocket, {"type": "status", "message": "A gerar relatório de avaliação..."})
             try:
-                # O evaluate_accuracy usa os resultados finais (initial_results)
-                report = evaluate_accuracy(
-                    predictions=initial_results, 
-                    ground_truth=ref_json
-                )
+                # O evaluate_accuracy usa os resultados finais (initial_results).
+                # É CPU-bound: corre numa thread.
+                report = await asyncio.to_thread(evaluate_accuracy, predictions=initial_results, ground_truth=ref_json)
                 
                 cfg_snapshot = {
                     "mode": current_cfg.get("mode", "unknown"),
@@ -303,15 +803,16 @@ async def websocket_extract_live(websocket: WebSocket):
                 report_filename = f"evaluation_report_{int(time.time())}.json"
                 report_path = Path("results") / report_filename
                 report_path_str = str(report_path)
-                save_json(report, report_path_str)
+                # A gravação não atrasa o envio do relatório à UI
+                _spawn_background(asyncio.to_thread(save_json, report, report_path_str))
                 
             except Exception as e:
-                print(f"Erro ao processar o ficheiro de avaliação: {e}")
+                logger.error("Erro ao processar o ficheiro de avaliação: %s", e)
                 report = {"error": f"Falha ao processar ficheiro de referência: {e}"}
         
-        print("DEBUG: Avaliação CONCLUÍDA. Enviando 'evaluation_complete'...")
+        logger.debug("Avaliação CONCLUÍDA. Enviando 'evaluation_complete'...")
         # Envia o relatório de avaliação para a UI (ATUALIZAÇÃO DINÂMICA)
-        await websocket.send_json({
+        await _ws_send_json(websocket, {
             "type": "evaluation_complete",
             "evaluation_report": report,
             "report_saved_to": report_path_str
@@ -319,49 +820,50 @@ async def websocket_extract_live(websocket: WebSocket):
         
         # 10. Esperar e Notificar sobre o Aprendizado de Regras (LENTO)
         if background_tasks:
-            print(f"DEBUG: Aguardando {len(background_tasks)} tarefas de aprendizado...")
-            await websocket.send_json({"type": "status", "message": f"A aguardar {len(background_tasks)} tarefas de aprendizado de regras..."})
+            logger.debug("Aguardando %s tarefas de aprendizado...", len(background_tasks))
+            await _ws_send_json(websocket, {"type": "status", "message": f"A aguardar {len(background_tasks)} tarefas de aprendizado de regras..."})
             await asyncio.gather(*background_tasks, return_exceptions=True)
             
-            print("DEBUG: Tarefas de aprendizado CONCLUÍDAS. Enviando 'learning_complete'...")
+            logger.debug("Tarefas de aprendizado CONCLUÍDAS. Enviando 'learning_complete'...")
             # Envia a notificação de aprendizado completo
-            await websocket.send_json({"type": "learning_complete"})
+            await _ws_send_json(websocket, {"type": "learning_complete"})
             
         # 11. Mensagem Final
-        print("DEBUG: Todos os processos concluídos. Enviando 'all_processes_complete'.")
-        await websocket.send_json({"type": "all_processes_complete"})
+        logger.debug("Todos os processos concluídos. Enviando 'all_processes_complete'.")
+        await _ws_send_json(websocket, {"type": "all_processes_complete"})
 
 
     except WebSocketDisconnect:
-        print("Cliente desconectado.")
+        logger.info("Cliente desconectado.")
     except Exception as e:
-        print(f"Erro inesperado no WebSocket: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Erro inesperado no WebSocket")
         try:
-            await websocket.send_json({"type": "error", "message": f"Erro interno do servidor: {str(e)}"})
+            await _ws_send_json(websocket, {"type": "error", "message": f"Erro interno do servidor: {str(e)}"})
         except:
             pass # A conexão pode estar morta.
     
     finally:
         # 12. Limpeza
+        if progress_sender and not progress_sender.done():
+            progress_sender.cancel()
         if temp_dir:
             try:
-                shutil.rmtree(temp_dir)
-                print(f"Diretório temporário {temp_dir} limpo.")
+                await _release_temp_dir(temp_dir)
+                logger.debug("Diretório temporário %s limpo.", temp_dir)
             except Exception as e:
-                print(f"Erro ao limpar o diretório temporário {temp_dir}: {e}")
+                logger.error("Erro ao limpar o diretório temporário %s: %s", temp_dir, e)
         
-        # --- Correção da Race Condition ---
-        if websocket.client_state != 'DISCONNECTED':
+        # Só fecha se nenhum dos lados o fez (os retornos antecipados já chamam close())
+        if (websocket.client_state == WebSocketState.CONNECTED
+                and websocket.application_state == WebSocketState.CONNECTED):
              try:
                  await websocket.close()
-                 print("Conexão WebSocket fechada pelo servidor.")
-             except RuntimeError as e:
-                 # Captura a race condition e a ignora silenciosamente (ou com log limpo)
-                 print(f"Info: WebSocket já fechado (provavelmente pelo cliente). A race condition foi capturada.")
+                 logger.info("Conexão WebSocket fechada pelo servidor.")
+             except RuntimeError:
+                 # O cliente pode desligar entre a verificação e o close()
+                 logger.debug("WebSocket fechado pelo cliente durante o close().")
         else:
-            print("Info: WebSocket já estava desconectado.")
+            logger.debug("WebSocket já estava desconectado.")
 
 
 # --- ENDPOINTS DE CONFIGURAÇÃO E MEMÓRIA (Inalterados) ---
@@ -381,43 +883,56 @@ async def update_config(new_config: Dict[str, Any] = Body(...)):
     if "cfg" not in app_state:
         raise HTTPException(status_code=503, detail="Configuração não inicializada.")
     
-    async with app_state["lock"]:
+    async with app_state["cfg_lock"]:
         try:
-            for key, value in new_config.items():
-                app_state["cfg"][key] = value
-            save_json(app_state["cfg"], app_state["cfg_path"])
-            print(f"Configuração atualizada. Novo modo: {app_state['cfg'].get('mode')}")
+            # Copy-on-write: os pedidos em curso continuam a ver a configuração anterior
+            updated_cfg = {**app_state["cfg"], **new_config}
+            # A escrita corre numa thread; o lock só serializa atualizações da configuração
+            await asyncio.to_thread(save_json, updated_cfg, app_state["cfg_path"])
+            app_state["cfg"] = updated_cfg
+            # Resultados guardados com a configuração anterior deixam de valer
+            app_state["result_cache"].clear()
+            logger.info("Configuração atualizada. Novo modo: %s", app_state['cfg'].get('mode'))
             return {"status": "success", "new_config": app_state["cfg"]}
         except Exception as e:
-            print(f"Erro ao salvar a configuração: {e}")
+            logger.error("Erro ao salvar a configuração: %s", e)
             raise HTTPException(status_code=500, detail=f"Erro ao salvar configuração: {e}")
 
 @app.delete("/memory/", 
             summary="Limpar a memória de regex",
             dependencies=[Depends(get_api_key)])
 async def clear_memory():
-    async with app_state["lock"]:
+    async with app_state["memory_lock"]:
         app_state["memory"] = {}
+        # Sem 'await' pelo meio: o journal passa logo para a memória nova, e as regras
+        # que ainda chegarem para a memória antiga são descartadas
+        app_state["journal"].reset(app_state["memory"])
+        # Limpar a sessão também descarta os resultados guardados em cache
+        app_state["result_cache"].clear()
         try:
-            save_json(app_state["memory"], app_state["memory_path_str"])
-            print("Memória limpa e salva.")
+            await asyncio.to_thread(save_json, {}, app_state["memory_path_str"])
+            logger.info("Memória limpa e salva.")
             return {"status": "success", "message": "Memória limpa."}
         except Exception as e:
-            print(f"Erro ao salvar a memória limpa: {e}")
+            logger.error("Erro ao salvar a memória limpa: %s", e)
             raise HTTPException(status_code=500, detail=f"Erro ao salvar memória: {e}")
 
 @app.get("/memory/download/", 
          summary="Baixar o ficheiro de memória atual",
          dependencies=[Depends(get_api_key)])
 async def download_memory():
-    async with app_state["lock"]:
-        # ESTA É A LINHA QUE SALVA ANTES DE BAIXAR
-        save_json(app_state["memory"], app_state["memory_path_str"])
+    async with app_state["memory_lock"]:
+        # Serializa a memória atual uma única vez (orjson -> bytes), sem passar pelo disco
+        payload = orjson.dumps(app_state["memory"], option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    
+    # O memory.json em disco é atualizado em background (incorpora o journal),
+    # sem atrasar o download
+    _spawn_background(_compact_memory())
     
-    return FileResponse(
-        app_state["memory_path_str"],
+    return Response(
+        content=payload,
         media_type='application/json',
-        filename=Path(app_state["memory_path_str"]).name
+        headers={"Content-Disposition": f'attachment; filename="{Path(app_state["memory_path_str"]).name}"'}
     )
 
 @app.post("/memory/upload/", 
@@ -426,18 +941,23 @@ async def download_memory():
 async def upload_memory(memory_file: UploadFile = File(..., description="O ficheiro memory.json para carregar.")):
     try:
         content = await memory_file.read()
-        new_memory = json.loads(content)
+        # Numa thread: o ficheiro pode ter vários MB
+        new_memory = await asyncio.to_thread(orjson.loads, content)
         
-        async with app_state["lock"]:
+        async with app_state["memory_lock"]:
             app_state["memory"] = new_memory
-            save_json(app_state["memory"], app_state["memory_path_str"])
-            print("Memória substituída por upload.")
+            # Sem 'await' pelo meio (ver clear_memory)
+            app_state["journal"].reset(new_memory)
+            # Resultados obtidos com as regras da memória anterior deixam de valer
+            app_state["result_cache"].clear()
+            await asyncio.to_thread(save_json, new_memory, app_state["memory_path_str"])
+            logger.info("Memória substituída por upload.")
             return {"status": "success", "message": f"Memória carregada com {len(new_memory)} labels."}
             
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=400, detail="O ficheiro de memória não é um JSON válido.")
     except Exception as e:
-        print(f"Erro ao carregar memória: {e}")
+        logger.error("Erro ao carregar memória: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro interno ao processar ficheiro: {e}")
     finally:
         await memory_file.close()
@@ -449,4 +969,23 @@ if __name__ == "__main__":
     print("A iniciar o servidor Uvicorn em http://127.0.0.1:8000")
     port = int(os.getenv("PORT", 8000))
     host = "0.0.0.0" if os.getenv("RENDER") else "127.0.0.1" 
-    uvicorn.run(app, host=host, port=port)
\ No newline at end of file
+    # uvloop + httptools (já incluídos em uvicorn[standard]); uvloop não existe no Windows.
+    # Um só worker: cada processo compacta o memory.json e roda o journal por conta própria,
+    # por isso vários workers apagariam as regras uns dos outros do disco.
+    if int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+        raise SystemExit("WEB_CONCURRENCY > 1 não é suportado: a memória e o journal exigem um único processo escritor.")
+    # O objeto 'app' (e não "api_main:app"): com a string, o uvicorn importava o módulo
+    # uma segunda vez e duplicava o QueueHandler, com uma fila que ninguém lê.
+    uvicorn.run(
+        app,
+        host=host,
+        port=port,
+        workers=1,
+        loop="asyncio" if os.name == "nt" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        backlog=int(os.getenv("BACKLOG", 2048)), # Fila de ligações por aceitar (picos de clientes)
+        proxy_headers=True,
+        ws_max_size=int(os.getenv("WS_MAX_SIZE", 16 * 1024 * 1024)), # Tamanho máximo de uma mensagem WebSocket
+        log_level=os.getenv("UVICORN_LOG_LEVEL", "info")
+    )
\ No newline at end of file
@@ -5,8 +5,8 @@ Ponto de entrada principal para o pipeline Papelada.
 """
 
 import sys
-import json
 import argparse
+import logging
 import os
 from pathlib import Path
 import asyncio
@@ -14,9 +14,10 @@ from dotenv import load_dotenv # Importar dotenv aqui
 from openai import AsyncOpenAI # Importar AsyncOpenAI aqui
 
 # --- Imports do seu novo pacote 'papelada' ---
-from papelada.utils import load_json
+from papelada.utils import load_json, save_json, KeyedLock
 from papelada.pipeline import load as load_pdfs
 from papelada.orchestrator import run as run_orchestrator, load_memory
+from papelada.llm import make_http_client
 
 def parse_argrs():
         parser = argparse.ArgumentParser(description="Process PDFs according to a JSON config.")
@@ -35,7 +36,7 @@ async def main(args) -> int:
         
         memory_path = Path(cfg.get("memory_file", "data/memory.json"))
         clean_memory_on_start = cfg.get("clean_memory_on_start", False)
-        memory_data = load_memory(memory_path, clean_start=clean_memory_on_start)
+        memory_data = {} if clean_memory_on_start else load_memory(memory_path)
 
         results_dir = Path("results")
         results_dir.mkdir(parents=True, exist_ok=True)
@@ -58,17 +59,38 @@ async def main(args) -> int:
         print("⚠️ AVISO: OPENAI_API_KEY não encontrada nas variáveis de ambiente.")
         return 1
         
-    # 2. Instancie o cliente AQUI
-    client = AsyncOpenAI()
+    # 2. Instancie o cliente AQUI (um só cliente: as chamadas de todos os PDFs partilham o pool HTTP)
+    #    O 'async with' fecha as ligações no fim, ainda dentro do event loop.
+    llm_http_cfg = cfg.get("llm_http", {})
+    async with AsyncOpenAI(http_client=make_http_client(llm_http_cfg), max_retries=llm_http_cfg.get("max_retries", 4)) as client:
+        # 3. Passe o cliente para o orquestrador, com os mesmos limites de concorrência da API
+        all_extraction_results, background_tasks = await run_orchestrator(
+            cfg, extr_schema, processed_pdfs, memory_data, client,
+            memory_lock=KeyedLock(),
+            llm_semaphore=asyncio.Semaphore(cfg.get("max_concurrent_llm", 32)),
+            learning_semaphore=asyncio.Semaphore(cfg.get("learning_concurrency", 8))
+        )
+        
+        # 4. No CLI não há servidor a seguir: espera pelo aprendizado e grava a memória
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
     
-    # 3. Passe o cliente para o orquestrador
-    all_extraction_results = await run_orchestrator(cfg, extr_schema, processed_pdfs, memory_data, client)
+    # Só grava se a memória foi carregada do disco: com clean_memory_on_start, gravar
+    # substituiria toda a memória aprendida (a da API incluída) pelas regras desta execução.
+    if background_tasks and clean_memory_on_start:
+        print(f"clean_memory_on_start=true: rules learned in this run were NOT saved to {memory_path}.")
+    elif background_tasks:
+        try:
+            save_json(memory_data, memory_path)
+            print(f"Memory saved to {memory_path}")
+        except Exception as e:
+            print(f"Error saving memory to {memory_path}: {e}")
 
     if all_extraction_results:
         try:
-            with open(output_file_path, 'w', encoding='utf-8') as f:
-                json.dump(all_extraction_results, f, indent=2, ensure_ascii=False)
-                print(f"Extraction results saved to {output_file_path}")
+            # save_json serializa com orjson (UTF-8 direto) e grava de forma atómica
+            save_json(all_extraction_results, output_file_path)
+            print(f"Extraction results saved to {output_file_path}")
         except Exception as e:
             print(f"Error saving results to output file {output_file_path}: {e}")
             
@@ -76,4 +98,6 @@ async def main(args) -> int:
 
 if __name__ == "__main__":
     args = parse_argrs()
+    # Os módulos de 'papelada' registam via logging; no CLI, vai tudo para o stderr
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(levelname)s %(name)s: %(message)s")
     sys.exit(asyncio.run(main(args)))
\ No newline at end of file
@@ -0,0 +1,74 @@
+import copy
+import time
+import hashlib
+import orjson
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def pdf_digest(data: bytes) -> str:
+    """
+    Impressão digital do conteúdo de um PDF. BLAKE2b é mais rápido que SHA-256
+    e o hashlib liberta o GIL em buffers grandes, por isso pode correr em threads.
+    """
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def config_fingerprint(cfg: dict) -> str:
+    """
+    Impressão digital das partes da configuração que mudam o resultado de uma
+    extração (modelo, prompts, reasoning/verbosity e normalização do texto).
+    """
+    relevant = {"llm": cfg.get("llm"), "normalization_options": cfg.get("normalization_options")}
+    return hashlib.blake2b(orjson.dumps(relevant, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+
+def make_result_key(digest: str, schema_job: dict, mode: str, cfg_fingerprint: str = "") -> str:
+    """
+    Chave de cache de um trabalho de extração: conteúdo do PDF + schema + modo
+    + configuração (ver config_fingerprint). O nome do ficheiro fica de fora, para
+    que o mesmo PDF reenviado com outro nome também seja um 'hit'.
+    """
+    canonical_schema = orjson.dumps(
+        {"label": schema_job.get("label"), "extraction_schema": schema_job.get("extraction_schema")},
+        option=orjson.OPT_SORT_KEYS
+    )
+    return hashlib.sha256(f"{digest}|{mode}|{cfg_fingerprint}|".encode("utf-8") + canonical_schema).hexdigest()
+
+
+class ResultCache:
+    """
+    Cache LRU em memória (com TTL) dos resultados de extração já produzidos.
+    Evita voltar a chamar o LLM para PDFs e schemas idênticos (reenvios,
+    recarregamentos do frontend, rondas de avaliação).
+    """
+    def __init__(self, max_entries: int = 256, ttl_s: float = 86400.0):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at > self.ttl_s:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        # Devolve uma cópia: quem chama altera o resultado (ex: 'pdf_path').
+        return copy.deepcopy(result)
+
+    def put(self, key: str, result: Dict[str, Any]):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic(), copy.deepcopy(result))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
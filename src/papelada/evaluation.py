@@ -1,7 +1,10 @@
 import json
+import logging
 from typing import List, Dict, Any
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 def _normalize_text(text: Any) -> str:
     """
     Normaliza o texto para comparação:
@@ -26,6 +29,7 @@ def evaluate_accuracy(predictions: List[Dict[str, Any]], ground_truth: List[Dict
     # MUDANÇA: Atualiza as métricas agregadas
     total_metrics = {
         "llm_data_calls": 0,
+        "llm_data_cache_hits": 0,
         "llm_data_tokens": 0,
         "llm_data_time_s": 0.0,
         "llm_regex_calls": 0,
@@ -46,7 +50,7 @@ def evaluate_accuracy(predictions: List[Dict[str, Any]], ground_truth: List[Dict
         pdf_key = Path(pred.get('pdf_path_original', pred['pdf_path'])).name
         
         if pdf_key not in gt_map:
-            print(f"Aviso: {pdf_key} está nas predições mas não no ficheiro de ground truth. A ignorar.")
+            logger.warning("%s está nas predições mas não no ficheiro de ground truth. A ignorar.", pdf_key)
             continue
             
         gt_data = gt_map[pdf_key]
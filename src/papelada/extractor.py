@@ -1,21 +1,75 @@
 import asyncio
+import functools
 import time
-import json
+import logging
 import re
-import os 
-import dotenv
-from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAIError
+from openai import AsyncOpenAI
 from .llm import LLMExtractor
+from .utils import bounded
+from typing import Dict, FrozenSet, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Prefixo literal de uma regex: tudo até ao primeiro metacaractere (ou '\\')
+_LITERAL_PREFIX = re.compile(r'[^\\^$.|?*+()\[\]{}]+')
+_MIN_ANCHOR_LEN = 3
+
+
+def _literal_anchor(pattern: str) -> Optional[str]:
+    """
+    Texto literal que qualquer match da regra tem de conter (ex: 'Inscrição:' em
+    'Inscrição:\\s*(\\d+)'), ou None quando não é seguro deduzi-lo.
+    Conservador: regras com alternância ('|') não têm âncora, e um último carácter
+    seguido de quantificador ('ab?', 'ab*', 'ab{0,1}') é retirado.
+    """
+    if '|' in pattern:
+        return None
+    match = _LITERAL_PREFIX.match(pattern)
+    if not match:
+        return None
+    anchor = match.group(0)
+    if pattern[match.end():match.end() + 1] in ('?', '*', '+', '{'):
+        anchor = anchor[:-1]
+    return anchor if len(anchor) >= _MIN_ANCHOR_LEN else None
+
+
+@functools.lru_cache(maxsize=512)
+def _compile_rule(pattern: str) -> "re.Pattern":
+    """Compila uma regra com as flags do projeto; partilhada pela validação e pelas tabelas de regras."""
+    return re.compile(pattern, re.MULTILINE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_rules(rules: FrozenSet[Tuple[str, str]]) -> Dict[str, Tuple["re.Pattern", Optional[str]]]:
+    """
+    Compila um conjunto de regras (campo, regex) uma única vez por processo.
+    Os PDFs de um lote com o mesmo label partilham as mesmas regras, por isso
+    só o primeiro Extractor paga a compilação. A chave são as próprias regras,
+    logo uma regra nova aprendida gera naturalmente uma tabela nova.
+    O dict devolvido é partilhado: só pode ser lido.
+    Cada campo guarda (regex compilada, âncora literal ou None).
+    """
+    compiled = {}
+    for field, pattern in rules:
+        try:
+            compiled[field] = (_compile_rule(pattern), _literal_anchor(pattern))
+        except re.error as e:
+            logger.error("Erro de Regex na regra conhecida para o campo '%s': %s. A regra será ignorada.", field, e)
+    return compiled
 
 
 class Extractor:
-    def __init__(self, config: dict, file_schema: dict, shared_memory: dict, lock: asyncio.Lock, client: AsyncOpenAI, mode: str):
+    def __init__(self, config: dict, file_schema: dict, shared_memory: dict, lock: asyncio.Lock, client: AsyncOpenAI, mode: str, journal=None, llm_semaphore=None, learning_semaphore=None):
         self.cfg = config
         self.client = client
         self.mode = mode 
+        self.journal = journal # MemoryJournal opcional: regista cada regra nova em disco
+        self.llm_semaphore = llm_semaphore # Semáforo partilhado que limita as chamadas LLM em simultâneo
+        self.learning_semaphore = learning_semaphore # Limita as tarefas de aprendizado de regras em simultâneo
 
         self.extracted_data = {key: 'null' for key in file_schema["extraction_schema"]}
+        # Campos ainda sem valor; o _apply retira-os à medida que as regras os preenchem
+        self._null_fields = set(self.extracted_data)
         self.extraction_schema = file_schema["extraction_schema"] # Este é o schema original (descrições)
         self.label = file_schema["label"]
         
@@ -26,6 +80,7 @@ class Extractor:
         
         self.metrics = {
             "llm_data_calls": 0,
+            "llm_data_cache_hits": 0, # Respostas servidas pela cache de respostas (sem chamada à API)
             "llm_data_tokens": 0,
             "llm_data_time_s": 0.0,
             "llm_regex_calls": 0,
@@ -35,6 +90,7 @@ class Extractor:
             "async_rule_generation_time_s": 0.0,
             "total_processing_time_s": 0.0,
             "used_memory_rule": 0, # Métrica para o log
+            "llm_data_error": 0, # 1 se a extração pelo LLM falhou (timeout, 429/5xx, JSON inválido)
         }
 
         memory_rules = self.memory.get(self.label, {})
@@ -44,6 +100,9 @@ class Extractor:
             if isinstance(rule_entry, str):
                 self.known_rules[key] = rule_entry
 
+        # Tabela de padrões partilhada entre todos os Extractors com as mesmas regras; o _apply só faz .search()
+        self.compiled_rules = _compile_rules(frozenset(self.known_rules.items()))
+
     def _normalize_for_validation(self, text: str) -> str:
         """
         Helper para normalizar texto para uma validação robusta.
@@ -57,28 +116,23 @@ class Extractor:
 
     def _apply(self, text: str, rules: dict) -> dict:
         """
-        Aplica as regras de 'self.known_rules'.
-        'rules' é agora um dict[str, str] (campo: "regex_string").
+        Aplica as regras de 'self.compiled_rules'.
+        'rules' é um dict[str, (re.Pattern, âncora)] (campo: regex já compilada).
         """
-        for field, pattern in rules.items():
-            if not isinstance(pattern, str): continue
+        for field, (pattern, anchor) in rules.items():
+            # Sem a âncora literal no texto a regex não pode casar: evita a busca com o motor de regex
+            if anchor is not None and anchor not in text:
+                continue
+            match = pattern.search(text)
             
-            try:
-                match = re.search(pattern, text, re.MULTILINE | re.DOTALL)
+            if match:
+                # Usa o span do grupo (1 se existir, senão o match inteiro); -1 = grupo não participou
+                start, end = match.span(1 if pattern.groups else 0)
                 
-                if match:
-                    if match.groups():
-                        group_content = match.group(1)
-                    else:
-                        group_content = match.group(0)
-                    
-                    if group_content is not None:
-                        self.extracted_data[field] = group_content.strip()
-                        self.metrics["used_memory_rule"] = 1 # Marca que usou regra
-                        print(f"Using known rule {pattern} on field {field}")
-            
-            except re.error as e:
-                print(f"Erro de Regex na regra conhecida para o campo '{field}': {e}. A regra será ignorada.")
+                if start != -1:
+                    self.extracted_data[field] = text[start:end].strip()
+                    self._null_fields.discard(field)
+                    self.metrics["used_memory_rule"] = 1 # Marca que usou regra
         
         return self.extracted_data
     
@@ -87,7 +141,7 @@ class Extractor:
         Gera e guarda regras de regex para o schema fornecido.
         MUDANÇA: Envia o schema completo (não mais um loop) para dar contexto ao LLM.
         """
-        print(f"  Stage: [BG] Generating and validating regex rules for {self.label} (Schema: {list(schema_for_learning.keys())})")
+        logger.debug("Stage: [BG] Generating and validating regex rules for %s (Schema: %s)", self.label, list(schema_for_learning))
         
         async_start_time = time.perf_counter()
         
@@ -98,14 +152,15 @@ class Extractor:
             
             # 2. Se não tivermos um schema para aprender, saia.
             if not schema_for_learning:
-                print(f"  [BG] Pulando aprendizado (schema de aprendizado vazio).")
+                logger.debug("[BG] Pulando aprendizado (schema de aprendizado vazio).")
                 return
 
             self.llm = LLMExtractor(
                 self.cfg["llm"], 
                 schema_for_learning, # Passa o schema completo com 'ref_value' e 'description'
                 text, 
-                client=self.client
+                client=self.client,
+                semaphore=self.llm_semaphore
             )
             
             start_llm_regex_time = time.perf_counter()
@@ -135,11 +190,12 @@ class Extractor:
                     is_valid_rule = False
                     
                     if not new_regex or not expected_value:
-                        print(f"  [BG] Regex ou valor esperado ausente para '{field}'. Pulando.")
+                        logger.debug("[BG] Regex ou valor esperado ausente para '%s'. Pulando.", field)
                         continue
 
                     try:
-                        match = re.search(new_regex, text, re.MULTILINE | re.DOTALL)
+                        # A regex validada fica já compilada para as tabelas de regras seguintes
+                        match = _compile_rule(new_regex).search(text)
                         extracted_value = None
                         if match:
                             if match.groups(): group_content = match.group(1)
@@ -153,34 +209,36 @@ class Extractor:
                         if norm_extracted and norm_extracted == norm_expected:
                             is_valid_rule = True
                         else:
-                            print(f"  [BG] Validação falhou para '{field}'.")
-                            print(f"     -> Esperado (Norm): '{norm_expected}'")
-                            print(f"     -> Regex obteve (Norm): '{norm_extracted}'")
-                            # Log bruto para depuração (opcional)
-                            # print(f"     -> Esperado (Bruto): '{expected_value}'")
-                            # print(f"     -> Regex obteve (Bruto): '{extracted_value}'")
+                            logger.debug(
+                                "[BG] Validação falhou para '%s'. Esperado (Norm): '%s' | Regex obteve (Norm): '%s'",
+                                field, norm_expected, norm_extracted
+                            )
                     
                     except re.error as e:
-                        print(f"⚠️  [BG] Invalid regex syntax for field '{field}': {new_regex}. Error: {e}")
+                        logger.warning("[BG] Invalid regex syntax for field '%s': %s. Error: %s", field, new_regex, e)
                         pass
                     
                     # 6. Salva na memória (se for válido)
                     if is_valid_rule:
                         async with self.lock:
-                            print(f"  [BG] New rule validated and saved for '{field}'.")
+                            logger.info("[BG] New rule validated and saved for '%s.%s'.", self.label, field)
                             self.memory[self.label][field] = new_regex
+                        if self.journal is not None:
+                            # Passa a memória onde a regra foi guardada: se foi limpa/substituída
+                            # entretanto, o journal descarta a regra em vez de a ressuscitar
+                            await asyncio.to_thread(self.journal.append, self.label, field, new_regex, self.memory)
                     else:
-                        print(f"  [BG] Generated rule for '{field}' failed validation.")
+                        logger.debug("[BG] Generated rule for '%s' failed validation.", field)
                         pass # Não salva a regra
             
             elif "error" in llm_extracted_rules:
-                 print(f"  [!] LLM regex generation failed: {llm_extracted_rules['error']}")
+                 logger.warning("LLM regex generation failed: %s", llm_extracted_rules['error'])
                  
             # --- FIM DA MUDANÇA ---
 
-            print(f"  Stage: [BG] Finished regex task for {self.label}.")
-        except Exception as e:
-            print(f"ERROR in background regex task for {self.label}: {e}")
+            logger.debug("Stage: [BG] Finished regex task for %s.", self.label)
+        except Exception:
+            logger.exception("ERROR in background regex task for %s", self.label)
         finally:
             async_end_time = time.perf_counter()
             total_async_duration = async_end_time - async_start_time
@@ -189,48 +247,55 @@ class Extractor:
                 self.metrics["async_rule_generation_time_s"] = total_async_duration
                 self.metrics["total_processing_time_s"] = self.metrics.get("sync_data_extraction_time_s", 0) + total_async_duration
     
+    async def _bounded_background_regex_task(self, text: str, schema_for_learning: dict):
+        """Corre a tarefa de aprendizado só quando houver vaga no semáforo de aprendizado."""
+        async with bounded(self.learning_semaphore):
+            await self._background_regex_task(text, schema_for_learning)
+
     async def extract(self, text: str, reusable_fields: set) -> tuple: 
         sync_start_time = time.perf_counter()
         
-        print(f"  Stage: Applying known rules for {self.label}")
+        logger.debug("Stage: Applying known rules for %s", self.label)
 
-        if self.known_rules:
-            self.extracted_data = self._apply(text, self.known_rules)
+        if self.compiled_rules:
+            self.extracted_data = self._apply(text, self.compiled_rules)
 
         background_task = None
         # Este dicionário conterá o schema APENAS para os campos que precisam aprender
         valid_fields_for_regex_gen = {}
 
         # Se algum campo ainda for 'null' APÓS aplicar as regras de memória
-        if 'null' in self.extracted_data.values():
+        if self._null_fields:
             
             # Se o cliente LLM não foi fornecido (ex: chave ausente), não podemos fazer mais nada.
             if self.client is None:
-                print(f"  [!] LLM client is None. Skipping LLM extraction for {self.label}.")
+                logger.debug("LLM client is None. Skipping LLM extraction for %s.", self.label)
                 sync_end_time = time.perf_counter()
                 self.metrics["sync_data_extraction_time_s"] = sync_end_time - sync_start_time
                 self.metrics["total_processing_time_s"] = self.metrics["sync_data_extraction_time_s"]
                 return self.extracted_data, None # Retorna o que foi pego da memória (ou nada)
 
             end_known_rules_time = time.perf_counter()
-            print(f"  Stage: Applying known rules completed in {end_known_rules_time - sync_start_time:.2f} seconds.")
-            print(f"  Stage: Extracting data with LLM for {self.label}")
+            logger.debug("Stage: Applying known rules completed in %.2f seconds.", end_known_rules_time - sync_start_time)
+            logger.debug("Stage: Extracting data with LLM for %s", self.label)
             
-            fields_to_extract = [k for k, v in self.extracted_data.items() if v == 'null']
-            # Usa 'self.extraction_schema' (o original) para obter as descrições
-            current_extraction_schema = {k: self.extraction_schema[k] for k in fields_to_extract if k in self.extraction_schema}
+            # Usa 'self.extraction_schema' (o original) para obter as descrições, pela ordem do schema
+            current_extraction_schema = {k: v for k, v in self.extraction_schema.items() if k in self._null_fields}
 
-            self.llm = LLMExtractor(self.cfg["llm"], current_extraction_schema, text, client=self.client)
+            self.llm = LLMExtractor(self.cfg["llm"], current_extraction_schema, text, client=self.client, semaphore=self.llm_semaphore)
             
             start_llm_data_time = time.perf_counter()
             llm_extracted_data = await self.llm.extract_data_json()
             end_llm_data_time = time.perf_counter()
             
-            self.metrics["llm_data_calls"] += 1
+            if llm_extracted_data.get("cache_hit"):
+                self.metrics["llm_data_cache_hits"] += 1
+            else:
+                self.metrics["llm_data_calls"] += 1
             self.metrics["llm_data_time_s"] += (end_llm_data_time - start_llm_data_time)
             self.metrics["llm_data_tokens"] += llm_extracted_data.get("usage", {}).get("total_tokens", 0)
 
-            print(f"  Stage: LLM data extraction completed in {end_llm_data_time - start_llm_data_time:.2f} seconds.")
+            logger.debug("Stage: LLM data extraction completed in %.2f seconds.", end_llm_data_time - start_llm_data_time)
         
             if "json_response" in llm_extracted_data:
                 
@@ -263,7 +328,8 @@ class Extractor:
                                 # --- FIM DA MUDANÇA ---
             
             elif "error" in llm_extracted_data:
-                print(f"  [!] LLM data extraction failed: {llm_extracted_data['error']}")
+                logger.warning("LLM data extraction failed: %s", llm_extracted_data['error'])
+                self.metrics["llm_data_error"] = 1
                 
 
         # Agora, o bloco 'if self.mode != "standard"' protege APENAS
@@ -272,7 +338,7 @@ class Extractor:
             # 'valid_fields_for_regex_gen' foi preenchido acima
             if valid_fields_for_regex_gen:
                 # MUDANÇA: Passa o schema de aprendizado explicitamente para a task
-                background_task = asyncio.create_task(self._background_regex_task(text, valid_fields_for_regex_gen))
+                background_task = asyncio.create_task(self._bounded_background_regex_task(text, valid_fields_for_regex_gen))
         
         sync_end_time = time.perf_counter()
         self.metrics["sync_data_extraction_time_s"] = sync_end_time - sync_start_time
@@ -0,0 +1,112 @@
+import os
+import orjson
+import threading
+from pathlib import Path
+
+from .utils import save_json
+
+
+class MemoryJournal:
+    """
+    Journal append-only (JSONL) das regras aprendidas.
+
+    Cada regra validada é acrescentada como uma linha {"label", "field", "rule"}
+    no momento em que é guardada na memória, por isso nada se perde se o processo
+    morrer antes do shutdown. O arranque lê o memory.json e reaplica o journal;
+    a compactação reescreve o memory.json e descarta as linhas já incorporadas.
+
+    O journal está associado (bind/reset) ao dict de memória em uso: uma regra
+    aprendida sobre uma memória entretanto limpa ou substituída não é escrita.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        # Journal "congelado" durante uma compactação em curso
+        self.rotated_path = self.path.with_name(self.path.name + ".old")
+        # Memória atual; None = aceita regras de qualquer origem
+        self.memory = None
+        # Ordena append/rotate/reset entre o event loop e as threads do to_thread
+        self._lock = threading.Lock()
+
+    def bind(self, memory: dict):
+        """Associa o journal ao dict de memória em uso."""
+        with self._lock:
+            self.memory = memory
+
+    # O_DSYNC: cada regra fica no disco quando o write retorna (não existe no Windows)
+    _APPEND_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_DSYNC", 0)
+
+    def append(self, label: str, field: str, rule: str, source: dict = None) -> bool:
+        """
+        Acrescenta uma regra. 'source' é o dict de memória onde a regra foi guardada:
+        se já não for a memória associada (limpa/substituída entretanto), a regra é
+        descartada e devolve False.
+        """
+        line = orjson.dumps({"label": label, "field": field, "rule": rule}, option=orjson.OPT_APPEND_NEWLINE)
+        with self._lock:
+            if source is not None and self.memory is not None and source is not self.memory:
+                return False
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Um único write() em O_APPEND: a linha nunca se mistura com outra
+            fd = os.open(self.path, self._APPEND_FLAGS, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        return True
+
+    def replay(self, memory: dict) -> int:
+        """Reaplica o journal (incluindo um eventual .old) sobre a memória. Devolve o nº de regras."""
+        applied = 0
+        for path in (self.rotated_path, self.path):
+            if not path.exists():
+                continue
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # Última linha cortada por um crash a meio da escrita
+                        continue
+                    memory.setdefault(entry["label"], {})[entry["field"]] = entry["rule"]
+                    applied += 1
+        return applied
+
+    def rotate(self, memory: dict) -> dict:
+        """
+        Congela o journal atual e devolve uma cópia da memória a gravar.
+        Deve ser chamado no event loop (sem 'await' pelo meio), para que a cópia
+        contenha exatamente as regras já escritas no journal congelado.
+        """
+        with self._lock:
+            if self.path.exists():
+                if self.rotated_path.exists():
+                    # Sobra de uma compactação que falhou: junta-lhe o journal atual em vez de a substituir
+                    with open(self.rotated_path, "ab+") as old, open(self.path, "rb") as live:
+                        # Uma última linha cortada por um crash não pode 'engolir' a primeira linha nova
+                        old.seek(0, os.SEEK_END)
+                        if old.tell():
+                            old.seek(-1, os.SEEK_END)
+                            if old.read(1) != b"\n":
+                                old.write(b"\n")
+                        old.write(live.read())
+                        old.flush()
+                        os.fsync(old.fileno())
+                    self.path.unlink()
+                else:
+                    os.replace(self.path, self.rotated_path)
+        return {label: dict(rules) for label, rules in memory.items()}
+
+    def compact(self, snapshot: dict, memory_path):
+        """Grava a cópia no memory.json e apaga o journal congelado. Pode correr numa thread."""
+        save_json(snapshot, memory_path)
+        self.rotated_path.unlink(missing_ok=True)
+
+    def reset(self, memory: dict = None):
+        """
+        Descarta o journal (ex: memória limpa ou substituída por upload) e associa-o
+        à nova memória, para que regras da memória antiga não voltem a ser escritas.
+        """
+        with self._lock:
+            self.path.unlink(missing_ok=True)
+            self.rotated_path.unlink(missing_ok=True)
+            self.memory = memory
@@ -1,62 +1,123 @@
 import asyncio
+import bisect
 import time
 import json
-from openai import OpenAIError
+import hashlib
+import orjson
+import functools
+import httpx
+from typing import Optional
+from openai import APITimeoutError, OpenAIError
+from .cache import ResultCache
+from .utils import bounded
+
+# Respostas de extração já obtidas, por prompt exato (mesmo texto + mesmo schema + mesmo modelo).
+# Criada no primeiro uso, com o tamanho de cfg["llm"]["response_cache"].
+_response_cache: Optional[ResultCache] = None
+
+def _get_response_cache(cfg: dict) -> ResultCache:
+    global _response_cache
+    if _response_cache is None:
+        cache_cfg = cfg.get("response_cache", {})
+        _response_cache = ResultCache(max_entries=cache_cfg.get("max_entries", 1024), ttl_s=cache_cfg.get("ttl_s", 86400))
+    return _response_cache
+
+
+def make_http_client(http_cfg: Optional[dict] = None) -> httpx.AsyncClient:
+    """
+    Cria o httpx.AsyncClient (HTTP/2, keep-alive) a partilhar por todos os clientes
+    AsyncOpenAI do processo. Os limites e o http2 vão no transporte, porque o
+    httpx ignora os do cliente quando recebe um transporte próprio; 'retries'
+    repete só falhas de ligação (o SDK da OpenAI já repete os 429/5xx).
+    """
+    http_cfg = http_cfg or {}
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=http_cfg.get("connect_retries", 2),
+        limits=httpx.Limits(
+            max_connections=http_cfg.get("max_connections", 200),
+            max_keepalive_connections=http_cfg.get("max_keepalive_connections", 50)
+        )
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(http_cfg.get("timeout_s", 60.0), connect=http_cfg.get("connect_timeout_s", 5.0))
+    )
+
+@functools.lru_cache(maxsize=8)
+def _load_prompt_index(prompt_file: str) -> dict:
+    """Lê o ficheiro de índice dos prompts uma vez por processo (não por extrator)."""
+    with open(prompt_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+@functools.lru_cache(maxsize=32)
+def _load_prompt_template(template_path: str) -> str:
+    """Lê um template de prompt uma vez por processo (não a cada chamada ao LLM)."""
+    try:
+        with open(template_path, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Prompt file not found: {template_path}")
+    except Exception as e:
+        raise Exception(f"Error reading prompt file: {e}")
+
+# Escala 0..1 do config -> nível da API: (-inf, 0], (0, 0.33], (0.33, 0.66], (0.66, +inf)
+_LEVEL_EDGES = (0, 0.33, 0.66)
+_REASONING_LEVELS = ("minimal", "low", "medium", "high")  # reasoning_effort
+_VERBOSITY_LEVELS = ("low", "low", "medium", "high")      # verbosity (não tem 'minimal')
+
+def _to_level(value: float, levels: tuple) -> str:
+    return levels[bisect.bisect_left(_LEVEL_EDGES, value)]
 
 class LLMExtractor:
-    def __init__(self, cfg: dict, campos_a_extrair: list, text_to_analyze: str, client=None): 
+    def __init__(self, cfg: dict, campos_a_extrair: list, text_to_analyze: str, client=None, semaphore=None): 
         self.model_name = cfg['model_name']
 
         if client is None:
             raise ValueError("Client cannot be None. Please provide an AsyncOpenAI client instance.")
         self.client = client
+        # Semáforo partilhado (opcional) que limita as chamadas em simultâneo à API,
+        # para não disparar rajadas de 429 quando o orquestrador abre muitas tarefas.
+        self.semaphore = semaphore
         
         self.campos_a_extrair = campos_a_extrair
         self.text_to_analyze = text_to_analyze
         
+        self.response_cache = _get_response_cache(cfg)
+        
         self.data_extr_ = cfg.get("data_extr_", {}).copy()
         self.regex_extr_ = cfg.get("regex_extr_", {}).copy()
         
-        with open(cfg['prompt_file'], "r", encoding="utf-8") as f:
-            prompts_data = json.load(f) 
-            self.data_extr_['prompt'] = prompts_data.get(self.data_extr_['prompt'])
-            self.regex_extr_['prompt'] = prompts_data.get(self.regex_extr_['prompt'])
-
-        def map_value_to_level(value):
-            if value <= 0: return "minimal" if 'reasoning' in locals() else "low"
-            elif value <= 0.33: return "low"
-            elif value <= 0.66: return "medium"
-            else: return "high"
-        
-        for config_key in ["regex_extr_", "data_extr_"]:
-            for key in ["reasoning", "temperature"]:
-                config = getattr(self, config_key)
-                if key == "reasoning": config[key] = map_value_to_level(config[key]) if config[key] > 0 else "minimal"
-                else: config[key] = map_value_to_level(config[key])
+        prompts_data = _load_prompt_index(cfg['prompt_file'])
+        self.data_extr_['prompt'] = prompts_data.get(self.data_extr_['prompt'])
+        self.regex_extr_['prompt'] = prompts_data.get(self.regex_extr_['prompt'])
+
+        for config in (self.regex_extr_, self.data_extr_):
+            config["reasoning"] = _to_level(config["reasoning"], _REASONING_LEVELS)
+            config["temperature"] = _to_level(config["temperature"], _VERBOSITY_LEVELS)
+
+        # Parâmetros fixos de cada pedido, montados uma vez; só a mensagem muda por chamada
+        self._data_request = self._request_kwargs(self.data_extr_)
+        self._regex_request = self._request_kwargs(self.regex_extr_)
+
+    def _request_kwargs(self, task_cfg: dict) -> dict:
+        return {
+            "model": self.model_name,
+            "response_format": {"type": "json_object"},
+            "temperature": 1,
+            "reasoning_effort": task_cfg["reasoning"],
+            "verbosity": task_cfg["temperature"],
+        }
 
     def _build_prompt(self, task: dict) -> str:
         if task["task"] == "data":
-            try:
-                with open(self.data_extr_['prompt']['prompt'], "r", encoding="utf-8") as f:
-                    prompt_content = f.read()
-            except FileNotFoundError:
-                raise FileNotFoundError(f"Prompt file not found: {self.data_extr_['prompt']['prompt']}")
-            except Exception as e:
-                raise Exception(f"Error reading prompt file: {e}")
-
+            prompt_content = _load_prompt_template(self.data_extr_['prompt']['prompt'])
             return prompt_content.format(
                 schema=self.campos_a_extrair,
                 text=self.text_to_analyze
             )
         elif task["task"] == "regex":
-            try:
-                with open(self.regex_extr_['prompt']['prompt'], "r", encoding="utf-8") as f:
-                    prompt_content = f.read()
-            except FileNotFoundError:
-                raise FileNotFoundError(f"Prompt file not found: {self.regex_extr_['prompt']['prompt']}")
-            except Exception as e:
-                raise Exception(f"Error reading prompt file: {e}")
-            
+            prompt_content = _load_prompt_template(self.regex_extr_['prompt']['prompt'])
             return prompt_content.format(
                 schema = self.campos_a_extrair,
                 text=self.text_to_analyze
@@ -64,38 +125,25 @@ class LLMExtractor:
         else:
             raise ValueError(f"Unknown task type: {task['task']}")
 
-    # --- MUDANÇA (Req 10s) ---
-    # O timeout da LLM foi aumentado para um valor mais generoso (30s),
-    # já que não está mais preso ao limite de 10s do orquestrador.
-    # Isto dá mais tempo para a geração de regex em background.
-    LLM_TIMEOUT = 30.0 
-
-    async def generate_regex_json(self) -> dict:
-        """Chama o LLM para gerar a lista JSON e INCLUI DADOS DE USO (tokens)."""
-        
-        prompt = self._build_prompt({"task": "regex"})
+    async def _complete_json(self, prompt: str, request_kwargs: dict) -> dict:
+        """Faz a chamada ao LLM (modo JSON) e devolve a resposta com os DADOS DE USO (tokens), ou {"error": ...}."""
         start_time = time.perf_counter()
         
-        messages = [{"role": "user", "content": prompt}]
-        
         try:
-            response = await asyncio.wait_for(
-                self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    response_format={"type": "json_object"},
-                    temperature=1,
-                    reasoning_effort=self.regex_extr_["reasoning"],
-                    verbosity= self.regex_extr_["temperature"]
-                ),
-                timeout=self.LLM_TIMEOUT
-            )
+            # Sem wait_for por fora: o timeout é o de cada tentativa (llm_http.timeout_s, no
+            # httpx.AsyncClient) e o SDK repete até max_retries vezes os 429/5xx/timeouts.
+            # Um limite global cortaria essas tentativas a meio.
+            async with bounded(self.semaphore):
+                response = await self.client.chat.completions.create(
+                    messages=[{"role": "user", "content": prompt}],
+                    **request_kwargs
+                )
             
             end_time = time.perf_counter()
             duration = end_time - start_time
             
             json_output_str = response.choices[0].message.content
-            json_output = json.loads(json_output_str)
+            json_output = orjson.loads(json_output_str)
             usage = response.usage 
 
             return {
@@ -110,59 +158,39 @@ class LLMExtractor:
                 }
             }
         
-        except asyncio.TimeoutError:
+        except (asyncio.TimeoutError, APITimeoutError):
              return {"error": f"LLM Timeout Error (model {self.model_name})", "model_name": self.model_name}
         except OpenAIError as e:
              return {"error": f"OpenAI API Error (model {self.model_name}): {e}", "model_name": self.model_name}
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
              return {"error": f"Falha ao decodificar JSON (model {self.model_name})", "model_name": self.model_name}
         except Exception as e:
             return {"error": f"Unexpected Error (model {self.model_name}): {e}", "model_name": self.model_name}
 
+    async def generate_regex_json(self) -> dict:
+        """Chama o LLM para gerar a lista JSON e INCLUI DADOS DE USO (tokens)."""
+        prompt = self._build_prompt({"task": "regex"})
+        return await self._complete_json(prompt, self._regex_request)
+
     async def extract_data_json(self) -> dict:
         """Chama o LLM para extrair dados e INCLUI DADOS DE USO (tokens)."""
         prompt = self._build_prompt({"task": "data"})
         start_time = time.perf_counter()
         
-        messages = [{"role": "user", "content": prompt}]
-               
-        try:
-            response = await asyncio.wait_for(
-                self.client.chat.completions.create(
-                    model=self.model_name,
-                    messages=messages,
-                    response_format={"type": "json_object"},
-                    temperature=1,
-                    reasoning_effort=self.data_extr_["reasoning"],
-                    verbosity= self.data_extr_["temperature"]
-                ),
-                timeout=self.LLM_TIMEOUT
-            )
-            
-            end_time = time.perf_counter()
-            duration = end_time - start_time
-            
-            json_output_str = response.choices[0].message.content
-            json_output = json.loads(json_output_str)
-            usage = response.usage
-
-            return {
-                "duration": duration,
-                "json_response": json_output,
-                "model_name": self.model_name,
-                "prompt_used": prompt,
-                "usage": {
-                    "prompt_tokens": usage.prompt_tokens,
-                    "completion_tokens": usage.completion_tokens,
-                    "total_tokens": usage.total_tokens
-                }
-            }
+        # Documento repetido (reenvio, mesmo formulário): devolve a resposta anterior sem chamar a API
+        cache_key = hashlib.blake2b(
+            f"{self.model_name}|{self.data_extr_['reasoning']}|{self.data_extr_['temperature']}|{prompt}".encode("utf-8"),
+            digest_size=32
+        ).hexdigest()
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            cached["duration"] = time.perf_counter() - start_time
+            cached["usage"] = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            cached["cache_hit"] = True
+            return cached
         
-        except asyncio.TimeoutError:
-             return {"error": f"LLM Timeout Error (model {self.model_name})", "model_name": self.model_name}
-        except OpenAIError as e:
-             return {"error": f"OpenAI API Error (model {self.model_name}): {e}", "model_name": self.model_name}
-        except json.JSONDecodeError as e:
-             return {"error": f"Falha ao decodificar JSON (model {self.model_name})", "model_name": self.model_name}
-        except Exception as e:
-            return {"error": f"Unexpected Error (model {self.model_name}): {e}", "model_name": self.model_name}
\ No newline at end of file
+        result = await self._complete_json(prompt, self._data_request)
+        if "json_response" in result:
+            # Sem o 'prompt_used' (o texto inteiro do documento): a cache guarda só a resposta
+            self.response_cache.put(cache_key, {k: v for k, v in result.items() if k != "prompt_used"})
+        return result
@@ -1,24 +1,28 @@
 import asyncio
-import json
+import inspect
+import logging
 import time
+import orjson
 from pathlib import Path
 from collections import defaultdict, Counter 
 from .extractor import Extractor
-from .utils import save_json, load_json 
-from typing import Callable, Awaitable, Any, Optional, Dict # Importações para o Callback
+from .utils import save_json, load_json, KeyedLock
+from typing import Callable, Awaitable, Any, Optional, Dict, Union # Importações para o Callback
+
+logger = logging.getLogger(__name__)
 
 def load_memory(path: Path) -> dict:
     """Carrega com segurança o arquivo de memória, retornando {} em caso de falha."""
     if not path.exists():
-        print(f"Memory file not found at {path}. Initializing empty memory.")
+        logger.debug("Memory file not found at %s. Initializing empty memory.", path)
         return {}
     try:
-        with open(path, 'r', encoding='utf-8') as f:
+        with open(path, 'rb') as f:
             content = f.read()
             if not content: return {}
-            return json.loads(content)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"Error loading memory file {path}: {e}. Initializing empty memory.")
+            return orjson.loads(content)
+    except (FileNotFoundError, orjson.JSONDecodeError) as e:
+        logger.error("Error loading memory file %s: %s. Initializing empty memory.", path, e)
         return {}
     
 # --- Função Auxiliar de Processamento (MODIFICADA com Callback) ---
@@ -28,40 +32,49 @@ async def process_schema(
     processed_pdfs: dict, 
     memory: dict, 
     client, 
-    memory_lock: asyncio.Lock, 
+    memory_lock: Union[asyncio.Lock, KeyedLock], 
     effective_mode: str,
     reusable_fields: set,
     background_tasks: list,
     all_results_dict: dict,
-    progress_callback: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None # <-- NOVO
+    progress_callback: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None, # <-- NOVO
+    journal=None, # MemoryJournal opcional para persistir regras novas
+    llm_semaphore: Optional[asyncio.Semaphore] = None, # Limite de chamadas LLM em simultâneo
+    learning_semaphore: Optional[asyncio.Semaphore] = None, # Limite de tarefas de aprendizado em simultâneo
 ):
     """
     Processa um único schema e chama o callback com o resultado.
     """
-    print(f"Processing PDF: {schema['pdf_path']} (Label: {schema['label']}, Mode: {effective_mode})")
+    logger.debug("Processing PDF: %s (Label: %s, Mode: %s)", schema['pdf_path'], schema['label'], effective_mode)
     
     sync_processing_start_time = time.perf_counter()
     
     # Se o cliente LLM for None (ex: modo standard sem chave), e o modo
     # não for standard, força o modo standard para evitar falhas.
     if client is None and effective_mode != "standard":
-        print(f"Aviso: Nenhuma chave LLM fornecida. Forçando 'standard' (apenas memória) para este item.")
+        logger.warning("Nenhuma chave LLM fornecida. Forçando 'standard' (apenas memória) para este item.")
         effective_mode = "standard"
         
-    extr_ = Extractor(cfg, schema, memory, memory_lock, client, mode=effective_mode)
+    # Com um KeyedLock, cada label tem o seu próprio lock de memória.
+    label_lock = memory_lock.get(schema['label']) if isinstance(memory_lock, KeyedLock) else memory_lock
+    extr_ = Extractor(cfg, schema, memory, label_lock, client, mode=effective_mode, journal=journal, llm_semaphore=llm_semaphore, learning_semaphore=learning_semaphore)
     
     result_data_final = None 
     
     try:
+        pdf_entry = processed_pdfs[schema['pdf_path']]
+        if inspect.isawaitable(pdf_entry):
+            # PDF ainda a ser processado em paralelo (pipeline.load_items_async)
+            pdf_entry = await pdf_entry
         result, task = await extr_.extract(
-            processed_pdfs[schema['pdf_path']]['normalized_data'], 
+            pdf_entry['normalized_data'], 
             reusable_fields
         )
         
         if task:
             background_tasks.append(task) 
 
-        print(f"Data Extracted from {schema['pdf_path']}:")
+        logger.debug("Data Extracted from %s:", schema['pdf_path'])
         
         sync_processing_end_time = time.perf_counter()
         sync_duration = sync_processing_end_time - sync_processing_start_time
@@ -76,9 +89,7 @@ async def process_schema(
         }
 
     except Exception as e:
-        print(f"EXTRACTOR ERROR: Falha em {schema['pdf_path']}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("EXTRACTOR ERROR: Falha em %s", schema['pdf_path'])
         result_data_final = {
             "label": schema["label"], 
             "pdf_path": schema["pdf_path"], 
@@ -99,7 +110,7 @@ async def process_schema(
                 "result": result_data_final
             })
         except Exception as e:
-            print(f"Erro ao chamar o callback de progresso: {e}")
+            logger.error("Erro ao chamar o callback de progresso: %s", e)
             
 
 # --- Nova Função Auxiliar para o Modo "Pro" (MODIFICADA com Callback) ---
@@ -109,12 +120,15 @@ async def run_label_group(
     processed_pdfs: dict, 
     memory: dict, 
     client, 
-    memory_lock: asyncio.Lock, 
+    memory_lock: Union[asyncio.Lock, KeyedLock], 
     global_mode: str, 
     reusable_fields_map: dict,
     background_tasks: list,
     all_results_dict: dict,
-    progress_callback: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None # <-- NOVO
+    progress_callback: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None, # <-- NOVO
+    journal=None, # MemoryJournal opcional para persistir regras novas
+    llm_semaphore: Optional[asyncio.Semaphore] = None, # Limite de chamadas LLM em simultâneo
+    learning_semaphore: Optional[asyncio.Semaphore] = None, # Limite de tarefas de aprendizado em simultâneo
 ):
     """
     Executa um grupo de 'label' completo sequencialmente (Regra "Pro").
@@ -139,7 +153,10 @@ async def run_label_group(
             reusable_fields=reusable_fields_map.get(schema['label'], set()),
             background_tasks=background_tasks,
             all_results_dict=all_results_dict,
-            progress_callback=progress_callback # <-- Passa adiante
+            progress_callback=progress_callback, # <-- Passa adiante
+            journal=journal,
+            llm_semaphore=llm_semaphore,
+            learning_semaphore=learning_semaphore
         )
 
 # --- run MODIFICADO (com Callback) ---
@@ -149,15 +166,18 @@ async def run(
     processed_pdfs: dict, 
     memory: dict, 
     client, 
-    memory_lock: asyncio.Lock, 
-    progress_callback: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None # <-- NOVO
+    memory_lock: Union[asyncio.Lock, KeyedLock], 
+    progress_callback: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None, # <-- NOVO
+    journal=None, # MemoryJournal opcional para persistir regras novas
+    llm_semaphore: Optional[asyncio.Semaphore] = None, # Limite de chamadas LLM em simultâneo
+    learning_semaphore: Optional[asyncio.Semaphore] = None, # Limite de tarefas de aprendizado em simultâneo
 ):
     
     all_results_dict = {} 
     background_tasks = [] 
     total_run_start_time = time.perf_counter()
     global_mode = cfg.get("mode", "standard")
-    print(f"Execution Mode: {global_mode.upper()}. Total PDFs to process: {len(extr_schema)}")
+    logger.info("Execution Mode: %s. Total PDFs to process: %s", global_mode.upper(), len(extr_schema))
 
     # --- ETAPA 1: PRÉ-ANÁLISE (Definição de Trabalhos e Campos Reutilizáveis) ---
     
@@ -216,7 +236,7 @@ async def run(
     if global_mode == "standard":
         # Modo Standard: Tudo é sequencial, sem aprendizado
         # (O 'process_schema' usará effective_mode="standard")
-        print("Modo 'Standard' selecionado. Todos os trabalhos serão executados sequencialmente sem aprendizado.")
+        logger.info("Modo 'Standard' selecionado. Todos os trabalhos serão executados sequencialmente sem aprendizado.")
         sequential_teacher_groups.append([job['schema'] for job in job_descriptors])
     
     else: # Modo Smart ou Pro
@@ -228,14 +248,14 @@ async def run(
             # (A lógica 'reusable_fields_in_group' foi removida pois o 'job_id' agora é diferente para 'smart')
             
             if is_warm:
-                print(f"JOB GROUP {job_id} (Warm): {len(group)} jobs -> Fila Paralela Rápida")
+                logger.info("JOB GROUP %s (Warm): %s jobs -> Fila Paralela Rápida", job_id, len(group))
                 parallel_warm_jobs.extend(group_schemas)
             elif is_orphan:
-                print(f"JOB GROUP {job_id} (Cold, Órfão): {len(group)} job -> Fila Paralela de Órfãos")
+                logger.info("JOB GROUP %s (Cold, Órfão): %s job -> Fila Paralela de Órfãos", job_id, len(group))
                 parallel_cold_orphans.extend(group_schemas)
             else:
                 # Se não for 'warm' e não for 'orphan', é um grupo de ensino
-                print(f"JOB GROUP {job_id} (Cold, Grupo de Ensino): {len(group)} jobs -> Fila Sequencial/Grupo")
+                logger.info("JOB GROUP %s (Cold, Grupo de Ensino): %s jobs -> Fila Sequencial/Grupo", job_id, len(group))
                 sequential_teacher_groups.append(group_schemas)
 
     # --- ETAPA 2: EXECUÇÃO (Modo "Pro" vs "Standard/Smart") ---
@@ -246,18 +266,18 @@ async def run(
         parallel_tasks.append(process_schema(
             schema, cfg, processed_pdfs, memory, client, memory_lock, "standard", # Modo "standard" pois é 'warm'
             set(), background_tasks, all_results_dict,
-            progress_callback=progress_callback 
+            progress_callback=progress_callback, journal=journal, llm_semaphore=llm_semaphore, learning_semaphore=learning_semaphore
         ))
     for schema in parallel_cold_orphans:
         parallel_tasks.append(process_schema(
             schema, cfg, processed_pdfs, memory, client, memory_lock, global_mode, 
             reusable_fields_map.get(schema['label'], set()), 
             background_tasks, all_results_dict,
-            progress_callback=progress_callback 
+            progress_callback=progress_callback, journal=journal, llm_semaphore=llm_semaphore, learning_semaphore=learning_semaphore
         ))
 
     if parallel_tasks:
-        print(f"\n--- Starting {len(parallel_tasks)} PARALLEL jobs (Warm + Órfãos) ---")
+        logger.info("--- Starting %s PARALLEL jobs (Warm + Órfãos) ---", len(parallel_tasks))
         await asyncio.gather(*parallel_tasks)
 
     # Jobs Sequenciais (Grupos de Ensino)
@@ -270,7 +290,7 @@ async def run(
                 len(group[0]['extraction_schema'])
             ), reverse=True)
             
-            print(f"\n--- Starting {len(sequential_teacher_groups)} SEQUENTIAL TEACHER GROUPS (Modo PRO: Paralelo por Label) ---")
+            logger.info("--- Starting %s SEQUENTIAL TEACHER GROUPS (Modo PRO: Paralelo por Label) ---", len(sequential_teacher_groups))
             
             # Cria uma "task" de asyncio para cada grupo de label
             group_tasks = []
@@ -278,7 +298,7 @@ async def run(
                 group_tasks.append(run_label_group(
                     group, cfg, processed_pdfs, memory, client, memory_lock, global_mode,
                     reusable_fields_map, background_tasks, all_results_dict,
-                    progress_callback=progress_callback
+                    progress_callback=progress_callback, journal=journal, llm_semaphore=llm_semaphore, learning_semaphore=learning_semaphore
                 ))
             
             # Executa os grupos de label em paralelo entre si
@@ -286,7 +306,7 @@ async def run(
             
         else:
             # --- Modo "Standard" ou "Smart" ---
-            print(f"\n--- Starting {len(sequential_teacher_groups)} JOB GROUPS (Modo {global_mode.upper()}: Sequencial) ---")
+            logger.info("--- Starting %s JOB GROUPS (Modo %s: Sequencial) ---", len(sequential_teacher_groups), global_mode.upper())
             
             # Achata a lista de grupos e executa ficheiro por ficheiro, sequencialmente
             all_sequential_jobs = [schema for group in sequential_teacher_groups for schema in group]
@@ -304,12 +324,12 @@ async def run(
                     schema, cfg, processed_pdfs, memory, client, memory_lock, global_mode,
                     reusable_fields_map.get(schema['label'], set()), 
                     background_tasks, all_results_dict,
-                    progress_callback=progress_callback
+                    progress_callback=progress_callback, journal=journal, llm_semaphore=llm_semaphore, learning_semaphore=learning_semaphore
                 )
 
     # --- FIM DA EXECUÇÃO ---
     total_run_end_time = time.perf_counter()
-    print(f"Total *orchestration* (sync part) completed in {total_run_end_time - total_run_start_time:.2f} seconds.")
+    logger.info("Total *orchestration* (sync part) completed in %.2f seconds.", total_run_end_time - total_run_start_time)
             
     final_results = [all_results_dict[schema['pdf_path']] for schema in extr_schema if schema['pdf_path'] in all_results_dict]
     
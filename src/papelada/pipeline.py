@@ -4,32 +4,50 @@ Contains all logic for finding, loading, and processing PDF files.
 This module is intended to be imported by main.py.
 """
 
+import io
 import re
 import json
+import logging
+import asyncio
 import unicodedata
 import pdfplumber
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Union
 import os
+import multiprocessing
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 # Imports relativos
 from .utils import load_json # (Não é usado aqui, mas seria se fosse)
 
+logger = logging.getLogger(__name__)
+
+# Regexes do clean/normalize, compiladas uma vez por processo (cada worker do pool as reutiliza em todos os PDFs)
+_LINE_ENDINGS_RE = re.compile(r'\r\n?')
+_WHITESPACE_RE = re.compile(r'\s+')
+_SPACE_BEFORE_PUNCT_RE = re.compile(r'\s+([,.;:!?)}\]])')
+_NEWLINES_RE = re.compile(r'\s*\n+\s*')
+
 # --- Text Processing Functions ---
-def _process(path: Path, cfg_dict: dict) -> tuple:
+def parse_one(path, cfg_dict: dict) -> dict:
     """
-    Worker function for parallel PDF processing. 
+    Extracts, cleans and normalizes a single PDF, given its path or its raw bytes.
     Must be defined globally for ProcessPoolExecutor to work.
     """
-    raw = extract(str(path))
+    raw = extract(path if isinstance(path, (bytes, bytearray)) else str(path))
     cleaned = clean(raw)
     normalized = normalize(cleaned, cfg_dict.get("normalization_options", cfg_dict))
-    return path.name, {"clean_data": cleaned, "normalized_data": normalized}
+    return {"clean_data": cleaned, "normalized_data": normalized}
 
-def load(pdf_path: str, cfg ) -> dict:
-    # ... (código inalterado) ...
+def _process(path: Path, cfg_dict: dict) -> tuple:
+    """
+    Worker function for parallel PDF processing. 
+    Must be defined globally for ProcessPoolExecutor to work.
+    """
+    return path.name, parse_one(path, cfg_dict)
+
+def _resolve_paths(pdf_path) -> List[Path]:
     if isinstance(pdf_path, (list, tuple)):
         paths = []
         for p in pdf_path:
@@ -51,8 +69,10 @@ def load(pdf_path: str, cfg ) -> dict:
 
     if not paths:
         raise FileNotFoundError(f"No PDF files found in: {pdf_path}")
-    if not paths:
-        raise FileNotFoundError(f"No PDF files found in: {pdf_path}")
+    return paths
+
+def load(pdf_path: str, cfg ) -> dict:
+    paths = _resolve_paths(pdf_path)
 
     results = {}
     max_workers = min(32, (os.cpu_count() or 1) + 4)
@@ -70,25 +90,69 @@ def load(pdf_path: str, cfg ) -> dict:
 
     return results
 
-def extract(pdf_path: str) -> str:
+def _init_worker_logging(level: int):
+    """
+    Initializer of the parsing workers: the package logger writes straight to stderr.
+    The parent's handlers (e.g. the API's QueueHandler) have no listener in the worker.
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    package_logger = logging.getLogger("papelada")
+    package_logger.handlers = [handler]
+    package_logger.setLevel(level)
+    package_logger.propagate = False
+
+def make_process_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Creates the long-lived process pool used by load_items_async.
+    Workers are started with 'spawn': forking a process that already runs threads
+    (the API's log listener, the event loop's executors) can deadlock the child on a
+    lock held at fork time, and would also carry over the parent's logging handlers.
+    """
+    return ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker_logging,
+        initargs=(logging.getLogger("papelada").getEffectiveLevel(),)
+    )
+
+def load_items_async(items: Dict[str, Union[bytes, str, Path]], cfg, executor: ProcessPoolExecutor) -> Dict[str, "asyncio.Future"]:
+    """
+    Non-blocking variant of load(): schedules every PDF on the caller's process
+    pool (e.g. created once at API startup, and shut down by its owner) and
+    returns immediately with {key: future}. 'items' maps each key to the PDF's
+    path or to its raw bytes (PDFs already held in memory skip the write-to-disk /
+    read-back round trip entirely). Each future resolves to the same dict load()
+    produces for that file, so extraction of the first PDFs can start (and call
+    the LLM) while the remaining ones are still being parsed.
+    Must be called from a running event loop.
+    """
+    cfg_for_process = cfg.to_dict() if hasattr(cfg, 'to_dict') else dict(cfg)
+    loop = asyncio.get_running_loop()
+    return {key: loop.run_in_executor(executor, parse_one, data, cfg_for_process) for key, data in items.items()}
+
+def extract(pdf_path) -> str:
     """
     Extracts raw text from a PDF file.
     
     Args:
-        pdf_path: Path to the PDF file.
+        pdf_path: Path to the PDF file, or the PDF's raw bytes.
 
     Returns:
         A string containing the extracted text.
     """
     extracted_text = ""
     try:
-        with pdfplumber.open(pdf_path) as pdf:
+        source = io.BytesIO(pdf_path) if isinstance(pdf_path, (bytes, bytearray)) else pdf_path
+        with pdfplumber.open(source) as pdf:
             for page in pdf.pages:
                 page_text = page.extract_text()
                 if page_text:
                     extracted_text += page_text + "\n"
     except Exception as e:
-        print(f"Error extracting data from PDF {pdf_path}: {e}")
+        # PDFs em memória chegam como bytes: regista só o tamanho, nunca o conteúdo
+        source_desc = f"<{len(pdf_path)} bytes in memory>" if isinstance(pdf_path, (bytes, bytearray)) else pdf_path
+        logger.error("Error extracting data from PDF %s: %s", source_desc, e)
         return "" # Return empty string on error
         
     return extracted_text
@@ -109,15 +173,15 @@ def clean(text: str) -> str:
         The cleaned text, preserving paragraph structure.
     """
     # 1. Normalize line endings (DOS/Mac -> Unix)
-    text = re.sub(r'\r\n?', '\n', text)
+    text = _LINE_ENDINGS_RE.sub('\n', text)
     
     # 2. Process line by line
     lines = text.split('\n')
     treated_lines = []
     for line in lines:
         line = line.strip() # Remove leading/trailing space
-        line = re.sub(r'\s+', ' ', line) # Remove internal duplicate spaces
-        line = re.sub(r'\s+([,.;:!?)}\]])', r'\1', line) # Remove space before punctuation
+        line = _WHITESPACE_RE.sub(' ', line) # Remove internal duplicate spaces
+        line = _SPACE_BEFORE_PUNCT_RE.sub(r'\1', line) # Remove space before punctuation
         
         # Add only if the line is not empty after cleaning
         if line: 
@@ -150,7 +214,7 @@ def normalize(text: str, options: dict = None) -> str:
     
     if options.get("flat", True):
         # Collapse all newlines (and surrounding space) into a single space
-        text = re.sub(r'\s*\n+\s*', ' ', text).strip()
+        text = _NEWLINES_RE.sub(' ', text).strip()
     
     if options.get("accents", True):
         # Remove accents
@@ -1,6 +1,13 @@
-import json
+import os
+import logging
+import threading
+import asyncio
+import contextlib
+import orjson
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
 
 def load_json(json_path: str) -> Any:
     """
@@ -10,17 +17,61 @@ def load_json(json_path: str) -> Any:
     p = Path(json_path)
     if not p.is_file():
         raise FileNotFoundError(f"JSON file not found: {json_path}")
-    return json.loads(p.read_text(encoding="utf-8"))
+    # orjson lê os bytes diretamente (sem decodificar para str primeiro), bem mais rápido que o json
+    return orjson.loads(p.read_bytes())
 
 def save_json(data: dict, json_path: str):
     """
-    Saves a dictionary to a JSON file.
+    Saves a dictionary to a JSON file, atomically.
+    The data goes to a temporary file that is fsync'ed and then renamed over the
+    target, so readers (and a restart after a crash) never see a half-written file.
     """
     p = Path(json_path)
+    # Nome único por thread: duas gravações simultâneas não partilham o ficheiro temporário
+    tmp = p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")
     try:
         p.parent.mkdir(parents=True, exist_ok=True)
-        with open(p, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        # orjson serializa direto para bytes UTF-8 (sem escapes ASCII), bem mais rápido que o json
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, p)
     except Exception as e:
-        print(f"Error saving JSON to {json_path}: {e}")
-        raise
\ No newline at end of file
+        tmp.unlink(missing_ok=True)
+        logger.error("Error saving JSON to %s: %s", json_path, e)
+        raise
+
+@contextlib.asynccontextmanager
+async def bounded(semaphore: Optional[asyncio.Semaphore]):
+    """
+    Ocupa uma vaga do semáforo durante o bloco; sem semáforo, não limita nada.
+    (contextlib.nullcontext só é 'async' a partir do Python 3.10.)
+    """
+    if semaphore is None:
+        yield
+    else:
+        async with semaphore:
+            yield
+
+class KeyedLock:
+    """
+    Entrega um asyncio.Lock por chave (ex: a 'label' do documento).
+    Escritas na memória de labels diferentes deixam de se serializar num
+    único lock global; só colisões na mesma label esperam umas pelas outras.
+    O número de locks acompanha o número de labels, tal como a própria memória.
+    """
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+
+    def get(self, key: Hashable) -> asyncio.Lock:
+        # Sem 'await' entre a leitura e a escrita: atómico no event loop.
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# Permite correr os testes sem 'pip install -e .': o pacote está em src/ e a API na raiz
+ROOT = Path(__file__).resolve().parent.parent
+for path in (ROOT / "src", ROOT):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
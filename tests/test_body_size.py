@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+import api_main
+from api_main import MaxBodySizeMiddleware
+
+
+async def _echo_length_app(scope, receive, send):
+    """App ASGI mínima: lê o corpo todo e responde com o seu tamanho."""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": str(len(body)).encode()})
+
+
+def _request(chunks, headers=()):
+    """Corre o middleware com o corpo partido em 'chunks'; devolve (status, corpo)."""
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": list(headers)}
+    pending = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return pending.pop(0) if pending else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(MaxBodySizeMiddleware(_echo_length_app)(scope, receive, send))
+    status = next(m["status"] for m in sent if m["type"] == "http.response.start")
+    body = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    return status, body
+
+
+@pytest.fixture(autouse=True)
+def small_limit(monkeypatch):
+    monkeypatch.setitem(api_main.app_state, "cfg", {"max_body_bytes": 10})
+
+
+def test_body_within_limit_passes_through():
+    assert _request([b"12345", b"67890"]) == (200, b"10")
+
+
+def test_rejects_large_content_length_before_reading():
+    status, body = _request([b"x"], headers=[(b"content-length", b"11")])
+    assert status == 413
+    assert b"demasiado grande" in body
+
+
+def test_rejects_chunked_body_over_limit():
+    status, _ = _request([b"x" * 6, b"x" * 6])
+    assert status == 413
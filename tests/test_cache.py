@@ -0,0 +1,55 @@
+from papelada import cache
+from papelada.cache import ResultCache, make_result_key
+
+
+def test_get_returns_isolated_copy():
+    results = ResultCache()
+    original = {"pdf_path": "a.pdf", "data": {"nome": "JOANA"}}
+    results.put("k", original)
+
+    original["data"]["nome"] = "alterado"
+    hit = results.get("k")
+    assert hit == {"pdf_path": "a.pdf", "data": {"nome": "JOANA"}}
+
+    hit["pdf_path"] = "b.pdf"
+    assert results.get("k")["pdf_path"] == "a.pdf"
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    results = ResultCache(ttl_s=10)
+    results.put("k", {"v": 1})
+
+    now[0] += 5
+    assert results.get("k") == {"v": 1}
+    now[0] += 6
+    assert results.get("k") is None
+    assert len(results) == 0
+
+
+def test_lru_eviction():
+    results = ResultCache(max_entries=2)
+    results.put("a", {"v": "a"})
+    results.put("b", {"v": "b"})
+    # 'a' passa a ser a mais recente; 'b' é a que sai
+    assert results.get("a") is not None
+    results.put("c", {"v": "c"})
+
+    assert results.get("b") is None
+    assert results.get("a") == {"v": "a"}
+    assert results.get("c") == {"v": "c"}
+
+
+def test_disabled_cache_stores_nothing():
+    results = ResultCache(max_entries=0)
+    results.put("k", {"v": 1})
+    assert results.get("k") is None
+
+
+def test_result_key_ignores_pdf_name_and_tracks_config():
+    job_a = {"label": "oab", "pdf_path": "a.pdf", "extraction_schema": {"nome": "Nome"}}
+    job_b = {"label": "oab", "pdf_path": "b.pdf", "extraction_schema": {"nome": "Nome"}}
+    assert make_result_key("d", job_a, "pro", "c1") == make_result_key("d", job_b, "pro", "c1")
+    assert make_result_key("d", job_a, "pro", "c1") != make_result_key("d", job_a, "pro", "c2")
+    assert make_result_key("d", job_a, "pro", "c1") != make_result_key("d", job_a, "smart", "c1")
@@ -0,0 +1,86 @@
+import orjson
+
+from papelada.journal import MemoryJournal
+
+
+def _lines(path):
+    return [orjson.loads(line) for line in path.read_bytes().splitlines()]
+
+
+def test_append_and_replay(tmp_path):
+    journal = MemoryJournal(tmp_path / "memory.journal")
+    assert journal.append("oab", "nome", r"Nome:\s*(.+)")
+    assert journal.append("oab", "inscricao", r"(\d+)")
+
+    memory = {}
+    assert journal.replay(memory) == 2
+    assert memory == {"oab": {"nome": r"Nome:\s*(.+)", "inscricao": r"(\d+)"}}
+
+
+def test_replay_ignores_truncated_last_line(tmp_path):
+    journal = MemoryJournal(tmp_path / "memory.journal")
+    journal.append("oab", "nome", "a")
+    with open(journal.path, "ab") as f:
+        f.write(b'{"label": "oab", "field": "sit')
+
+    memory = {}
+    assert journal.replay(memory) == 1
+    assert memory == {"oab": {"nome": "a"}}
+
+
+def test_rotate_and_compact(tmp_path):
+    journal = MemoryJournal(tmp_path / "memory.journal")
+    memory = {"oab": {"nome": "a"}}
+    journal.append("oab", "nome", "a")
+
+    snapshot = journal.rotate(memory)
+    assert not journal.path.exists()
+    assert journal.rotated_path.exists()
+    # A cópia não acompanha alterações posteriores à memória
+    memory["oab"]["nome"] = "b"
+    assert snapshot == {"oab": {"nome": "a"}}
+
+    memory_path = tmp_path / "memory.json"
+    journal.compact(snapshot, memory_path)
+    assert not journal.rotated_path.exists()
+    assert orjson.loads(memory_path.read_bytes()) == {"oab": {"nome": "a"}}
+
+
+def test_rotate_merges_leftover_old(tmp_path):
+    journal = MemoryJournal(tmp_path / "memory.journal")
+    # Sobra de uma compactação falhada, com a última linha cortada
+    journal.rotated_path.write_bytes(b'{"label": "oab", "field": "nome", "rule": "a"}\n{"label": "oab"')
+    journal.append("oab", "situacao", "b")
+
+    journal.rotate({})
+    assert not journal.path.exists()
+
+    memory = {}
+    assert journal.replay(memory) == 2
+    assert memory == {"oab": {"nome": "a", "situacao": "b"}}
+
+
+def test_append_skips_rules_from_replaced_memory(tmp_path):
+    journal = MemoryJournal(tmp_path / "memory.journal")
+    old_memory = {}
+    journal.bind(old_memory)
+    assert journal.append("oab", "nome", "a", source=old_memory)
+
+    new_memory = {}
+    journal.reset(new_memory)
+    assert not journal.path.exists()
+    assert not journal.append("oab", "nome", "stale", source=old_memory)
+    assert journal.append("oab", "nome", "fresh", source=new_memory)
+    assert _lines(journal.path) == [{"label": "oab", "field": "nome", "rule": "fresh"}]
+
+
+def test_reset_discards_both_files(tmp_path):
+    journal = MemoryJournal(tmp_path / "memory.journal")
+    journal.append("oab", "nome", "a")
+    journal.rotate({})
+    journal.append("oab", "nome", "b")
+
+    journal.reset({})
+    assert not journal.path.exists()
+    assert not journal.rotated_path.exists()
+    assert journal.replay({}) == 0
@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip("openai")
+
+from papelada.extractor import _literal_anchor
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    (r"Inscrição:\s*(\d+)", "Inscrição:"),
+    (r"Valor(.*)", "Valor"),
+    (r"abcd+", "abc"),
+    (r"abc?d", None),
+    (r"Nome|Name", None),
+    (r"^Nome", None),
+    (r"(?i)nome", None),
+    (r"ab(\d+)", None),
+])
+def test_literal_anchor(pattern, expected):
+    assert _literal_anchor(pattern) == expected
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("openai")
+
+from papelada.llm import _REASONING_LEVELS, _VERBOSITY_LEVELS, _to_level
+
+
+@pytest.mark.parametrize("value, reasoning, verbosity", [
+    (-1, "minimal", "low"),
+    (0, "minimal", "low"),
+    (0.01, "low", "low"),
+    (0.33, "low", "low"),
+    (0.34, "medium", "medium"),
+    (0.66, "medium", "medium"),
+    (0.67, "high", "high"),
+    (1, "high", "high"),
+])
+def test_to_level(value, reasoning, verbosity):
+    assert _to_level(value, _REASONING_LEVELS) == reasoning
+    assert _to_level(value, _VERBOSITY_LEVELS) == verbosity
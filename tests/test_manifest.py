@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("fastapi")
+
+from api_main import _validate_pdf_manifest
+
+
+def test_valid_manifest():
+    assert _validate_pdf_manifest([{"name": "a.pdf", "size": 10}, {"name": "b.pdf", "size": 0}]) is None
+
+
+@pytest.mark.parametrize("name", ["../a.pdf", "dir/a.pdf", "..\\a.pdf", "/etc/passwd", "..", ".", "", None])
+def test_rejects_paths_and_empty_names(name):
+    assert _validate_pdf_manifest([{"name": name, "size": 1}]) is not None
+
+
+def test_rejects_duplicate_names():
+    error = _validate_pdf_manifest([{"name": "a.pdf", "size": 1}, {"name": "a.pdf", "size": 2}])
+    assert "repetido" in error
+
+
+@pytest.mark.parametrize("size", [True, -1, "10", 1.5, None])
+def test_rejects_invalid_sizes(size):
+    assert _validate_pdf_manifest([{"name": "a.pdf", "size": size}]) is not None
+
+
+def test_rejects_non_list_and_non_object_entries():
+    assert _validate_pdf_manifest({"name": "a.pdf", "size": 1}) is not None
+    assert _validate_pdf_manifest(["a.pdf"]) is not None
@@ -0,0 +1,57 @@
+import asyncio
+
+import orjson
+import pytest
+
+pytest.importorskip("fastapi")
+
+from api_main import _send_progress_batches
+
+
+class _FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+
+    async def send_text(self, text):
+        self.frames.append(orjson.loads(text))
+
+
+def _run(producer, interval_s=0.01):
+    websocket = _FakeWebSocket()
+
+    async def main():
+        queue = asyncio.Queue()
+        sender = asyncio.create_task(_send_progress_batches(websocket, queue, interval_s))
+        await producer(queue)
+        await asyncio.wait_for(sender, timeout=1)
+
+    asyncio.run(main())
+    return websocket.frames
+
+
+def test_sentinel_flushes_pending_results():
+    async def producer(queue):
+        for i in range(3):
+            queue.put_nowait({"pdf_path": f"{i}.pdf"})
+        queue.put_nowait(None)
+
+    frames = _run(producer)
+    assert frames == [{"type": "progress_batch", "results": [{"pdf_path": "0.pdf"}, {"pdf_path": "1.pdf"}, {"pdf_path": "2.pdf"}]}]
+
+
+def test_sentinel_alone_sends_nothing():
+    async def producer(queue):
+        queue.put_nowait(None)
+
+    assert _run(producer) == []
+
+
+def test_results_after_the_interval_go_in_a_new_batch():
+    async def producer(queue):
+        queue.put_nowait({"pdf_path": "a.pdf"})
+        await asyncio.sleep(0.05)
+        queue.put_nowait({"pdf_path": "b.pdf"})
+        queue.put_nowait(None)
+
+    frames = _run(producer)
+    assert [frame["results"] for frame in frames] == [[{"pdf_path": "a.pdf"}], [{"pdf_path": "b.pdf"}]]
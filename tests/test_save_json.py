@@ -0,0 +1,36 @@
+import orjson
+import pytest
+
+from papelada import utils
+from papelada.utils import load_json, save_json
+
+
+def test_round_trip_creates_parent_dirs(tmp_path):
+    path = tmp_path / "data" / "memory.json"
+    save_json({"oab": {"nome": "Nome:\\s*(.+)"}, 1: "ç"}, str(path))
+    assert load_json(str(path)) == {"oab": {"nome": "Nome:\\s*(.+)"}, "1": "ç"}
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_failed_write_keeps_previous_file(tmp_path, monkeypatch):
+    path = tmp_path / "memory.json"
+    save_json({"versao": 1}, str(path))
+
+    def broken_fsync(fd):
+        raise OSError("disco cheio")
+
+    monkeypatch.setattr(utils.os, "fsync", broken_fsync)
+    with pytest.raises(OSError):
+        save_json({"versao": 2}, str(path))
+
+    # O ficheiro antigo continua inteiro e o temporário foi apagado
+    assert orjson.loads(path.read_bytes()) == {"versao": 1}
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_unserializable_data_keeps_previous_file(tmp_path):
+    path = tmp_path / "memory.json"
+    save_json({"versao": 1}, str(path))
+    with pytest.raises(TypeError):
+        save_json({"versao": object()}, str(path))
+    assert load_json(str(path)) == {"versao": 1}